@@ -0,0 +1,336 @@
+#!venv/Scripts/python
+
+# Runs a saved OpStack (.ops file from the StackEditor) over a dataset directory, without any UI.
+# Images are processed on a pool of worker processes; each worker writes the processed image
+# and the Tesseract box data into the output directory, mirroring the dataset's layout.
+
+import sys
+import os
+import argparse
+import json
+import math
+import time
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# OpenCV ----
+import cv2
+import numpy as np
+# --------------
+
+from rrUtilities.ImageOperations import *
+# TesseractWrapper
+from rrUtilities.TesseractWrapper import *
+# DiskCache for reusing step results between runs
+from rrUtilities.ResultCache import MemoryCache, DiskCache
+# read_image_in_bands, for splitting receipts into bands of text
+from rrUtilities.TextSegmentation import read_image_in_bands
+# getting is_valid_file for argparse
+from rrUtilities.TypeHelpers import *
+
+
+VALID_IMG_EXTS = [".png", ".jpg"]
+
+tesseract_path = r'resources\Tesseract-OCR\tesseract'
+tesseract_input_mode = "png"
+dataset_path = "dataset"
+output_path = "output"
+step_disk_cache_path = os.path.join("cache", "steps")
+step_disk_cache_mb = 2048
+ocr_batch_size = 8
+ocr_cache_mb = 64
+ocr_disk_cache_path = os.path.join("cache", "ocr")
+ocr_disk_cache_mb = 256
+ocr_text_bands = False
+
+
+# ================= WORKER PROCESSES ==================
+
+# each worker process builds its own processer and Tesseract wrapper once, in init_worker
+worker_processer = None
+worker_text_reader = None
+# only with ocr_text_bands: reads the bands of each image in parallel
+worker_tesseract_pool = None
+
+def init_worker(stack_data, tesseract_path, tesseract_threads, tesseract_input_mode, step_disk_cache_path, step_disk_cache_mb, ocr_cache_config = None, text_bands = False):
+	global worker_processer, worker_text_reader, worker_tesseract_pool
+
+	# we already get our parallelism from the process pool
+	cv2.setNumThreads(1)
+
+	stack = OperationStack()
+	stack.deserialize(stack_data)
+
+	step_disk_cache = None
+	if step_disk_cache_path:
+		step_disk_cache = DiskCache(step_disk_cache_path, step_disk_cache_mb * 1024 * 1024, STEP_CACHE_SALT)
+
+	worker_processer = ImageProcesser(stack, None, step_disk_cache, keep_intermediates = False)
+	# [memory mb, disk path, disk mb], or None for no OCR cache
+	ocr_cache = None
+	if ocr_cache_config:
+		ocr_cache = create_ocr_cache(*ocr_cache_config)
+	worker_text_reader = TesseractWrapper(tesseract_path, tesseract_threads, tesseract_input_mode, ocr_cache)
+	if text_bands:
+		# the worker's share of the cores goes to that many single-threaded Tesseract processes instead
+		worker_tesseract_pool = TesseractPool(tesseract_path, tesseract_threads, tesseract_threads, tesseract_input_mode, ocr_cache)
+
+def read_one_image(img):
+	if worker_tesseract_pool is not None:
+		return read_image_in_bands(worker_tesseract_pool, img)
+	return worker_text_reader.read_image(img)
+
+# writes the processed image and its boxes next to each other in the output directory, returns the box count.
+# The boxes are in the coordinates of the dataset image, even if the stack resized or rotated it (see map_boxes_to_input)
+def write_output(file, cleaned_img, boxes, dataset_path, output_path):
+	out_base = os.path.splitext(os.path.join(output_path, os.path.relpath(file, dataset_path)))[0]
+	os.makedirs(os.path.dirname(out_base), exist_ok = True)
+	cv2.imwrite(out_base + ".png", cleaned_img)
+	with open(out_base + ".box", 'w', encoding = 'utf8') as outfile:
+		outfile.write(format_boxes(boxes))
+	return len(boxes)
+
+# returns a list of [file, seconds, box count, error string or None], one for each file
+def process_files(files, dataset_path, output_path):
+	results = []
+	# [result, cleaned image, step geometry] for the files that made it through the stack
+	processed = []
+	for file in files:
+		start_time = time.perf_counter()
+		try:
+			img = cv2.imread(file, cv2.IMREAD_COLOR)
+			if img is None:
+				results.append([file, time.perf_counter() - start_time, 0, "image read failed"])
+				continue
+			
+			# the processer reuses its buffers, so each image in the batch needs its own copy
+			cleaned_img = np.copy(worker_processer.process_color_image(img))
+			result = [file, time.perf_counter() - start_time, 0, None]
+			results.append(result)
+			processed.append([result, cleaned_img, worker_processer.get_last_step_geometry()])
+			
+		except Exception as error:
+			results.append([file, time.perf_counter() - start_time, 0, str(error)])
+			
+	if not processed:
+		return results
+	
+	# one Tesseract process reads the whole batch, and each image is charged an equal share of it
+	start_time = time.perf_counter()
+	all_boxes = [None] * len(processed)
+	if worker_tesseract_pool is None:
+		try:
+			all_boxes = worker_text_reader.read_images([p[1] for p in processed])
+		except Exception:
+			# one of the images is broken; read them one at a time below to find out which
+			pass
+	ocr_share = (time.perf_counter() - start_time) / len(processed)
+	
+	for [result, cleaned_img, step_geometry], boxes in zip(processed, all_boxes):
+		start_time = time.perf_counter()
+		try:
+			if boxes is None:
+				boxes = read_one_image(cleaned_img)
+			boxes = map_boxes_to_input(boxes, step_geometry)
+			result[2] = write_output(result[0], cleaned_img, boxes, dataset_path, output_path)
+		except Exception as error:
+			result[3] = str(error)
+		result[1] += ocr_share + time.perf_counter() - start_time
+		
+	return results
+
+
+# ================= APPLICATION ENTRY POINT ==================
+
+def load_dataset(dataset_path):
+	dataset = []
+	for root, dirs, files in os.walk(dataset_path):
+		for file in files:
+			if os.path.splitext(file)[1].lower() in VALID_IMG_EXTS:
+				dataset.append(os.path.join(root, file))
+	dataset.sort()
+	return dataset
+
+# Checks that our runs (fused, final image only) and the StackEditor's (every step) key the stack's
+# output the same way, so they share step disk cache entries: runs the stack both ways on the first
+# sample_count images through one cache, and reports the images where the batch run would miss.
+def check_cache_keys(dataset, stack_data, sample_count):
+	stack = OperationStack()
+	stack.deserialize(stack_data)
+	cache = MemoryCache()
+	editor_processer = ImageProcesser(stack, cache, keep_intermediates = True)
+	batch_processer = ImageProcesser(stack, cache, keep_intermediates = False)
+	
+	checked = 0
+	for file in dataset[:sample_count]:
+		img = cv2.imread(file, cv2.IMREAD_COLOR)
+		if img is None:
+			continue
+		checked += 1
+		editor_processer.process_color_image(img)
+		batch_processer.process_color_image(img)
+		editor_key = editor_processer.get_last_results()[-1][2]
+		batch_key = batch_processer.get_last_results()[-1][2]
+		if batch_key != editor_key or cache.get(batch_key) is None:
+			print("WARNING: {0} is cached under a different key by the StackEditor".format(file))
+			print(describe_plan(batch_processer.get_last_plan(), stack.get_stack()))
+	print("Checked the step cache keys of {0} image(s)".format(checked))
+
+# times every Tesseract input mode on the same processed frames, one at a time in this process,
+# and checks that they all give the same boxes as pytesseract.image_to_boxes (the original read path, timed first)
+def benchmark_input_modes(dataset, stack_data, tesseract_path, sample_count):
+	init_worker(stack_data, tesseract_path, get_threads_per_worker(1), "png", None, 0)
+	
+	frames = []
+	for file in dataset[:sample_count]:
+		img = cv2.imread(file, cv2.IMREAD_COLOR)
+		if img is not None:
+			# the processer reuses its buffers, so keep a copy of each frame
+			frames.append(np.copy(worker_processer.process_color_image(img)))
+	print("Benchmarking Tesseract input modes on {0} image(s)".format(len(frames)))
+	print("=================")
+	if not frames:
+		return
+	
+	# "pytesseract" isn't an input mode, just the reference every mode is compared to
+	reference = None
+	for mode in ["pytesseract"] + TESSERACT_INPUT_MODES:
+		reader = TesseractWrapper(tesseract_path, get_threads_per_worker(1), "png" if mode == "pytesseract" else mode)
+		read = reader.read_image_pytesseract if mode == "pytesseract" else reader.read_image
+		latencies = []
+		outputs = []
+		for frame in frames:
+			start_time = time.perf_counter()
+			outputs.append(read(frame))
+			latencies.append(time.perf_counter() - start_time)
+		if reference is None:
+			reference = outputs
+			status = "is the reference"
+		elif all(np.array_equal(boxes, reference_boxes) for boxes, reference_boxes in zip(outputs, reference)):
+			status = "matches pytesseract"
+		else:
+			status = "DIFFERS from pytesseract"
+		
+		print("{0:>11}: mean = {1:.3f}s, p95 = {2:.3f}s, output {3}".format(mode,
+			np.mean(latencies),
+			np.percentile(latencies, 95),
+			status))
+
+def print_summary(results, wall_time):
+	latencies = [r[1] for r in results if r[3] is None]
+	failures = [r for r in results if r[3] is not None]
+
+	print("=================")
+	print("Processed {0} image(s) in {1:.2f}s ({2} failed)".format(len(results), wall_time, len(failures)))
+	for file, seconds, box_count, error in failures:
+		print("\tFAILED {0}: {1}".format(file, error))
+
+	if latencies:
+		print("Throughput: {0:.2f} images/s".format(len(latencies) / wall_time))
+		print("Latency per image: p50 = {0:.3f}s, p95 = {1:.3f}s".format(
+			np.percentile(latencies, 50),
+			np.percentile(latencies, 95)))
+
+
+if __name__ == "__main__":
+	print("--- BatchRunner ---")
+	print("Using Python version: " + sys.version)
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-s", dest="stack_textio", required=True,
+								help="OpStack file (.ops) to run", metavar="FILE",
+								type=lambda x: is_valid_file(parser, x))
+	parser.add_argument("-c", dest="config_textio", default="resources/config.yaml",
+								help="YAML config file", metavar="FILE",
+								type=lambda x: is_valid_file(parser, x))
+	parser.add_argument("-d", dest="dataset_path", default=None,
+								help="dataset directory (overrides the config)", metavar="DIR")
+	parser.add_argument("-o", dest="output_path", default=None,
+								help="output directory (overrides the config)", metavar="DIR")
+	parser.add_argument("-j", dest="workers", default=None, type=int,
+								help="number of worker processes (default: one per core)")
+	parser.add_argument("-m", dest="tesseract_input_mode", default=None, choices=TESSERACT_INPUT_MODES,
+								help="how frames are handed to Tesseract (overrides the config)")
+	parser.add_argument("-n", dest="ocr_batch_size", default=None, type=int,
+								help="images per Tesseract process (overrides the config)")
+	parser.add_argument("-t", dest="ocr_text_bands", action="store_true",
+								help="split each image into bands of text and OCR them in parallel")
+	parser.add_argument("-b", dest="benchmark_count", default=None, type=int, metavar="N",
+								help="check the step cache keys and benchmark the Tesseract input modes on the first N images, then exit")
+	args = parser.parse_args()
+
+	# PyYaml Config Parsing ----
+	config = yaml.safe_load(args.config_textio.read())
+	if config:
+		if 'tesseract_path' in config:
+			tesseract_path = config['tesseract_path']
+		if 'tesseract_input_mode' in config:
+			tesseract_input_mode = config['tesseract_input_mode']
+		if 'dataset_path' in config:
+			dataset_path = config['dataset_path']
+		if 'output_path' in config:
+			output_path = config['output_path']
+		if 'step_disk_cache_path' in config:
+			step_disk_cache_path = config['step_disk_cache_path']
+		if 'step_disk_cache_mb' in config:
+			step_disk_cache_mb = config['step_disk_cache_mb']
+		if 'ocr_batch_size' in config:
+			ocr_batch_size = config['ocr_batch_size']
+		if 'ocr_cache_mb' in config:
+			ocr_cache_mb = config['ocr_cache_mb']
+		if 'ocr_disk_cache_path' in config:
+			ocr_disk_cache_path = config['ocr_disk_cache_path']
+		if 'ocr_disk_cache_mb' in config:
+			ocr_disk_cache_mb = config['ocr_disk_cache_mb']
+		if 'ocr_text_bands' in config:
+			ocr_text_bands = config['ocr_text_bands']
+
+	if args.dataset_path:
+		dataset_path = args.dataset_path
+	if args.output_path:
+		output_path = args.output_path
+	if args.tesseract_input_mode:
+		tesseract_input_mode = args.tesseract_input_mode
+	if args.ocr_batch_size:
+		ocr_batch_size = args.ocr_batch_size
+	if args.ocr_text_bands:
+		ocr_text_bands = True
+	workers = args.workers if args.workers else os.cpu_count()
+	# each worker runs one Tesseract process at a time, so split the cores between them
+	tesseract_threads = get_threads_per_worker(workers)
+	#------------------------------
+
+	try:
+		stack_data = json.load(args.stack_textio)
+	except json.decoder.JSONDecodeError as error:
+		print("ERROR while parsing stack file: {0}".format(error))
+		sys.exit(1)
+
+	dataset = load_dataset(dataset_path)
+	if args.benchmark_count:
+		check_cache_keys(dataset, stack_data, args.benchmark_count)
+		benchmark_input_modes(dataset, stack_data, tesseract_path, args.benchmark_count)
+		sys.exit(0)
+	
+	# batches shouldn't be so big that some workers get nothing to do
+	ocr_batch_size = max(1, min(ocr_batch_size, math.ceil(len(dataset) / workers)))
+	batches = [dataset[i:i + ocr_batch_size] for i in range(0, len(dataset), ocr_batch_size)]
+	
+	print("Running {0} on {1} image(s) from {2} with {3} worker(s), {4} Tesseract thread(s) each, {5} image(s) per Tesseract process".format(
+		args.stack_textio.name, len(dataset), dataset_path, workers, tesseract_threads, ocr_batch_size))
+	print("=================")
+
+	results = []
+	start_time = time.perf_counter()
+	with ProcessPoolExecutor(max_workers = workers,
+							initializer = init_worker,
+							initargs = (stack_data, tesseract_path, tesseract_threads, tesseract_input_mode, step_disk_cache_path, step_disk_cache_mb,
+											[ocr_cache_mb, ocr_disk_cache_path, ocr_disk_cache_mb], ocr_text_bands)) as executor:
+		futures = [executor.submit(process_files, batch, dataset_path, output_path) for batch in batches]
+		for future in as_completed(futures):
+			for result in future.result():
+				results.append(result)
+				print("[{0}/{1}] {2} ({3:.3f}s)".format(len(results), len(dataset), result[0], result[1]))
+
+	print_summary(results, time.perf_counter() - start_time)
+
+#EOF
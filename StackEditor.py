@@ -9,6 +9,10 @@ from PyQt5.QtGui import *
 from rrUtilities.ImageOperations import *
 # DirWatcher for watching dataset directories for changes
 from rrUtilities.DirWatcher import DirWatcher
+# MemoryCache and DiskCache for keeping step results between refreshes and sessions
+from rrUtilities.ResultCache import MemoryCache, DiskCache
+# StackThreadManager for running the stack in the background
+from rrUtilities.StackThread import StackThreadManager
 # getting is_valid_file for argparse
 from rrUtilities.TypeHelpers import *
 
@@ -51,7 +55,7 @@ from queue import Queue
 # 	fix scrolling out on image viewers 
 # 	[DONE] add a check box to auto-update tesseract preview
 # 	[DONE] add stack saving / opening
-# 	add boundaries and warping operations
+# 	[DONE] add boundaries and warping operations
 # 	add undo/redo stack
 # 	fix behavior of threshold panel, disabled fields don't update properly
 # 	add better logging system with verbosity
@@ -63,8 +67,24 @@ DEFAULT_MAIN_WINDOW_X = 0 #500
 DEFAULT_TESSERACT_PREVIEW_X = -800 #1800
 
 TESSERACT_PATH = r'resources\Tesseract-OCR\tesseract'
-
-DIR_BLACKLIST = ["venv", ".git", "__pycache__", "Tesseract-OCR", "rrUtilities", "rrWidgets"]
+TESSERACT_INPUT_MODE = "png"
+# memory budget for the step results cache, so a slider tick only reruns the ops after the one that changed
+STEP_CACHE_MB = 512
+# persistent step results cache, shared with main.py (None disables it)
+STEP_DISK_CACHE_PATH = os.path.join("cache", "steps")
+STEP_DISK_CACHE_MB = 2048
+# OCR results cache, keyed by the content of the final image (see OcrCache)
+OCR_CACHE_MB = 64
+OCR_DISK_CACHE_PATH = os.path.join("cache", "ocr")
+OCR_DISK_CACHE_MB = 256
+# while a slider is being dragged, the stack runs on a copy of the image downscaled to about this many pixels,
+# and the full resolution pass runs when the slider is released, or after this long without a change
+PROXY_MAX_PIXELS = 1000000
+PROXY_IDLE_MS = 300
+# soft changes closer together than this are run as one
+SOFT_CHANGE_DEBOUNCE_MS = 30
+
+DIR_BLACKLIST = ["venv", ".git", "__pycache__", "Tesseract-OCR", "rrUtilities", "rrWidgets", "cache", "output"]
 VALID_IMG_EXTS = [".png", ".jpg"]
 
 # this widget shows all the images in the dataset, 
@@ -356,6 +376,9 @@ class StackEditor(QMainWindow):
 		if self.stackDirty:
 			success = self.askToSave()
 		if success:
+			self.tesseractPreviewWidget.shutdown()
+			self.stackThreadManager.stop()
+			self.fullStackPreviewerWidget.shutdown()
 			event.accept()
 		else:
 			event.ignore()
@@ -369,16 +392,45 @@ class StackEditor(QMainWindow):
 		#members
 		self.loadedStack = None
 		self.currentImage = None
+		# downscaled copy of currentImage for soft changes (None when it's small enough already)
+		self.proxyImage = None
+		self.proxyScale = 1.0
 		self.currentOpIndex = 0
 		self.stackDirty = False
 		self.currentFilepath = None
 		self.updateFilenameInTitle()
 		
+		self.stepCache = MemoryCache(STEP_CACHE_MB * 1024 * 1024)
+		self.stepDiskCache = None
+		if STEP_DISK_CACHE_PATH:
+			self.stepDiskCache = DiskCache(STEP_DISK_CACHE_PATH, STEP_DISK_CACHE_MB * 1024 * 1024, STEP_CACHE_SALT)
+		
+		# the stack runs in the background; the step caches belong to this thread from here on
+		self.stackThreadManager = StackThreadManager(self.stepCache, self.stepDiskCache)
+		self.stackThreadManager.onRequestComplete.connect(self.processingFinished)
+		self.stackThreadManager.onRequestFailed.connect(self.processingFailed)
+		# set when the stack changed shape, so the next results rebuild the preview tabs instead of updating them
+		self.previewTabsStale = False
+		
+		# replaces the proxy preview with the full resolution one once the user stops changing things
+		self.fullResolutionTimer = QTimer(self)
+		self.fullResolutionTimer.setSingleShot(True)
+		self.fullResolutionTimer.timeout.connect(lambda: self.refresh_image_only(False))
+		# coalesces bursts of soft changes (every tick of a slider drag) into one proxy run
+		self.softChangeTimer = QTimer(self)
+		self.softChangeTimer.setSingleShot(True)
+		self.softChangeTimer.timeout.connect(self.refresh_proxy)
+		
 		self.op_types = [
 			MorphologicalOperation,
 			ThresholdOperation,
 			BitwiseNotOperation,
 			BlurOperation,
+			TextScaleOperation,
+			DeskewOperation,
+			ReceiptCropOperation,
+			LocalThresholdOperation,
+			ComponentFilterOperation,
 		]
 		
 		#UI
@@ -395,7 +447,8 @@ class StackEditor(QMainWindow):
 		self.datasetViewerWidget.setup()
 		
 		self.tesseractPreviewWidget = TesseractPreviewWidget(self, True)
-		self.tesseractPreviewWidget.setup(TESSERACT_PATH)
+		self.tesseractPreviewWidget.setup(TESSERACT_PATH, TESSERACT_INPUT_MODE,
+			create_ocr_cache(OCR_CACHE_MB, OCR_DISK_CACHE_PATH, OCR_DISK_CACHE_MB))
 		
 		self.setCentralWidget(self.stackPreviewerWidget)
 		self.addDockWidget(Qt.LeftDockWidgetArea, self.stackModifierWidget)
@@ -420,7 +473,8 @@ class StackEditor(QMainWindow):
 		# hook up signals from operation editor
 		#self.operationEditorWidget.onPropertyChanged.connect(self.refresh)
 		self.operationEditorWidget.onPropertyChanged.connect(self.refresh_image_only)
-		self.operationEditorWidget.onPropertySoftChanged.connect(self.refresh_image_only)
+		# soft changes (e.g. dragging a slider) run on the proxy image
+		self.operationEditorWidget.onPropertySoftChanged.connect(lambda: self.softChangeTimer.start(SOFT_CHANGE_DEBOUNCE_MS))
 
 		# hook up signals from dataset viewer
 		self.datasetViewerWidget.fileSelected.connect(self.fileSelected)
@@ -504,30 +558,66 @@ class StackEditor(QMainWindow):
 
 	# ------------------ UPDATING PREVIEW IMAGES / STACK PROPERTIES ----------------------
 
-	def refresh_image_only(self):
+	# The stack runs on the StackThreadManager; the previews update in processingFinished.
+	def refresh_image_only(self, persist = True):
+		self.fullResolutionTimer.stop()
+		self.softChangeTimer.stop()
 		if self.loadedStack is not None and self.currentImage is not None:
-			processer = ImageProcesser(self.loadedStack)
-			processer.process_color_image(self.currentImage)
-			self.processResults = processer.get_last_results()
+			self.stackThreadManager.start_processing(self.loadedStack, self.currentImage, persist)
+		
+			self.stackModifierWidget.update_names(self.loadedStack)
+		
+	# Quick preview for soft changes: runs the proxy stack on the downscaled image, skipping Tesseract,
+	# and schedules a full resolution refresh for when the changes stop.
+	# Proxy results skip the disk cache, and aren't kept in self.processResults.
+	def refresh_proxy(self):
+		if self.proxyImage is None:
+			# soft changes skip writing to the disk cache
+			self.refresh_image_only(False)
+			return
+		if self.loadedStack is not None:
+			proxy_stack = self.loadedStack.get_proxy_stack(self.proxyScale)
+			self.stackThreadManager.start_processing(proxy_stack, self.proxyImage, False, self.proxyScale)
 			
-			self.stackPreviewerWidget.update_from_results(self.processResults)
-			self.fullStackPreviewerWidget.update_from_results(self.processResults)
+			self.stackModifierWidget.update_names(self.loadedStack)
+			self.fullResolutionTimer.start(PROXY_IDLE_MS)
 			
-			self.tesseractPreviewWidget.update_from_results(self.processResults)
+	def processingFailed(self, request_id, error):
+		if not self.stackThreadManager.is_latest(request_id):
+			return
+		# the previews are left showing an older stack, so the next results rebuild them,
+		# and we don't retry the same stack at full resolution on our own
+		self.previewTabsStale = True
+		self.fullResolutionTimer.stop()
+		
+	def processingFinished(self, request_id):
+		results = self.stackThreadManager.get_results(request_id)
+		if results is None:
+			# a newer run is on its way
+			return
+		process_results, ops, scale = results
+		
+		if self.previewTabsStale:
+			self.previewTabsStale = False
+			self.stackPreviewerWidget.setup_from_results(process_results, ops, 1.0 / scale)
+			self.fullStackPreviewerWidget.setup_from_results(process_results)
+			self.stackPreviewerWidget.set_current_index(self.currentOpIndex)
+			self.fullStackPreviewerWidget.set_current_index(self.currentOpIndex)
+		else:
+			self.stackPreviewerWidget.update_from_results(process_results, ops, 1.0 / scale)
+			self.fullStackPreviewerWidget.update_from_results(process_results)
 		
-			self.stackModifierWidget.update_names(self.loadedStack)
+		if scale == 1.0:
+			self.processResults = process_results
+			self.tesseractPreviewWidget.update_from_results(self.processResults)
 		
 	def refresh(self):
+		self.fullResolutionTimer.stop()
+		self.softChangeTimer.stop()
 		if self.loadedStack is not None:
 			if self.currentImage is not None:
-				processer = ImageProcesser(self.loadedStack)
-				processer.process_color_image(self.currentImage)
-				self.processResults = processer.get_last_results()
-				
-				self.stackPreviewerWidget.setup_from_results(self.processResults)
-				self.fullStackPreviewerWidget.setup_from_results(self.processResults)
-				
-				self.tesseractPreviewWidget.update_from_results(self.processResults)
+				self.previewTabsStale = True
+				self.stackThreadManager.start_processing(self.loadedStack, self.currentImage)
 			else:
 				self.stackPreviewerWidget.clear()
 				self.fullStackPreviewerWidget.clear()
@@ -544,6 +634,16 @@ class StackEditor(QMainWindow):
 
 	def use_image(self, img):
 		self.currentImage = img
+		
+		self.proxyImage = None
+		self.proxyScale = 1.0
+		# img is None when the editor is started without an image (refresh clears the previews then)
+		if img is not None:
+			height, width = img.shape[:2]
+			if height * width > PROXY_MAX_PIXELS:
+				self.proxyScale = (PROXY_MAX_PIXELS / (height * width)) ** 0.5
+				proxy_size = (max(1, round(width * self.proxyScale)), max(1, round(height * self.proxyScale)))
+				self.proxyImage = cv2.resize(img, proxy_size, interpolation = cv2.INTER_AREA)
 		self.refresh()
 		
 
@@ -795,6 +895,20 @@ if __name__=="__main__":
 
 		if 'tesseract_path' in config:
 			TESSERACT_PATH = config['tesseract_path']
+		if 'tesseract_input_mode' in config:
+			TESSERACT_INPUT_MODE = config['tesseract_input_mode']
+		if 'step_cache_mb' in config:
+			STEP_CACHE_MB = config['step_cache_mb']
+		if 'step_disk_cache_path' in config:
+			STEP_DISK_CACHE_PATH = config['step_disk_cache_path']
+		if 'step_disk_cache_mb' in config:
+			STEP_DISK_CACHE_MB = config['step_disk_cache_mb']
+		if 'ocr_cache_mb' in config:
+			OCR_CACHE_MB = config['ocr_cache_mb']
+		if 'ocr_disk_cache_path' in config:
+			OCR_DISK_CACHE_PATH = config['ocr_disk_cache_path']
+		if 'ocr_disk_cache_mb' in config:
+			OCR_DISK_CACHE_MB = config['ocr_disk_cache_mb']
 	
 	
 	# default startup stack
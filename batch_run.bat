@@ -0,0 +1,8 @@
+@ECHO ON
+cd /D %~dp0
+CALL venv\Scripts\activate
+python BatchRunner.py -s pretty_ok.ops -c resources/config.yaml
+@ECHO OFF 
+CALL deactivate
+@ECHO ON
+pause
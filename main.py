@@ -17,6 +17,10 @@ from rrUtilities.ImageOperations import *
 from rrUtilities.TesseractWrapper import *
 # ImageResizer
 from rrUtilities.ImageResizer import *
+# DiskCache for reusing step results between runs
+from rrUtilities.ResultCache import DiskCache
+# read_image_in_bands, for splitting receipts into bands of text
+from rrUtilities.TextSegmentation import read_image_in_bands
 
 # getting is_valid_file for argparse
 from rrUtilities.TypeHelpers import *
@@ -28,7 +32,15 @@ print("Current working directory: " + os.getcwd())
 DEBUG = True
 config_textio = io.TextIOWrapper(open("resources/config.yaml", 'r'), encoding='utf8', newline='\n')
 tesseract_path = r'resources\Tesseract-OCR\tesseract'
+tesseract_input_mode = "png"
 dataset_path = "dataset"
+step_disk_cache_path = os.path.join("cache", "steps")
+step_disk_cache_mb = 2048
+ocr_batch_size = 8
+ocr_cache_mb = 64
+ocr_disk_cache_path = os.path.join("cache", "ocr")
+ocr_disk_cache_mb = 256
+ocr_text_bands = False
 
 
 parser = argparse.ArgumentParser()
@@ -51,11 +63,38 @@ if DEBUG:
 
 if 'tesseract_path' in config:
 	tesseract_path = config['tesseract_path']
+if 'tesseract_input_mode' in config:
+	tesseract_input_mode = config['tesseract_input_mode']
 if 'dataset_path' in config:
 	dataset_path = config['dataset_path']
+if 'step_disk_cache_path' in config:
+	step_disk_cache_path = config['step_disk_cache_path']
+if 'step_disk_cache_mb' in config:
+	step_disk_cache_mb = config['step_disk_cache_mb']
+if 'ocr_batch_size' in config:
+	ocr_batch_size = config['ocr_batch_size']
+if 'ocr_cache_mb' in config:
+	ocr_cache_mb = config['ocr_cache_mb']
+if 'ocr_disk_cache_path' in config:
+	ocr_disk_cache_path = config['ocr_disk_cache_path']
+if 'ocr_disk_cache_mb' in config:
+	ocr_disk_cache_mb = config['ocr_disk_cache_mb']
+if 'ocr_text_bands' in config:
+	ocr_text_bands = config['ocr_text_bands']
 #------------------------------
 
-text_reader = TesseractWrapper(tesseract_path)
+# rereading an image with the same stack (or with one that gives the same final image) skips Tesseract
+ocr_cache = create_ocr_cache(ocr_cache_mb, ocr_disk_cache_path, ocr_disk_cache_mb)
+text_reader = TesseractWrapper(tesseract_path, input_mode = tesseract_input_mode, cache = ocr_cache)
+# splitting long receipts into bands of text lets several Tesseract processes read one image
+tesseract_pool = None
+if ocr_text_bands:
+	tesseract_pool = TesseractPool(tesseract_path, input_mode = tesseract_input_mode, cache = ocr_cache)
+
+# shared with the StackEditor, so a rerun with a changed stack only recomputes the ops after the change
+step_disk_cache = None
+if step_disk_cache_path:
+	step_disk_cache = DiskCache(step_disk_cache_path, step_disk_cache_mb * 1024 * 1024, STEP_CACHE_SALT)
 
 # Load Dataset ----
 dataset = []
@@ -73,104 +112,120 @@ if DEBUG:
 
 print("=================")
 
-for file in dataset:
-	# Load an color image in grayscale
-	# load image
-	img = cv2.imread(file,cv2.IMREAD_GRAYSCALE)
-	"""
-	# Canny edge detection
-	edges = cv2.Canny(img,100,200)
-	
-	# dilate to make edges thicker
-	kernel = np.ones((3,3),np.uint8)
-	dilation = cv2.dilate(edges,kernel,iterations = 1)
-	
-	# Hough line transform
-	minLineLength = math.floor(0.5 * img.shape[0])
-	lines = cv2.HoughLines(dilation,5,np.pi/2,minLineLength)	# image, pixel pos resolution, angular resolution, threshold (min length)
-	
-	# draw the lines on the img
-	backtorgb = cv2.cvtColor(dilation, cv2.COLOR_GRAY2RGB)
-	linelen = 1000
-	if lines is not None:
-		for rho,theta in [line[0] for line in lines]:
-			a = np.cos(theta)
-			b = np.sin(theta)
-			x0 = a*rho
-			y0 = b*rho 
-			x1 = int(x0 + linelen*(-b))
-			y1 = int(y0 + linelen*(a))
-			x2 = int(x0 - linelen*(-b))
-			y2 = int(y0 - linelen*(a))
+# binary thresholding followed by morphological cleanup
+thresholds = [
+ThresholdOperation().set_threshold(127, cv2.THRESH_BINARY),
+ThresholdOperation().set_adaptive_threshold(cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2),
+ThresholdOperation().set_adaptive_threshold(cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2),
+	
+# Otsu's thresholding
+ThresholdOperation().set_threshold(0, cv2.THRESH_BINARY+cv2.THRESH_OTSU),
+]
+	
+# Otsu's thresholding after Gaussian filtering
+#ip2 = ImageProcesser()
+#ip2.add_operation(BlurOperation(kernelSize = 5))
+#ip2.add_operation(thresholds[3])
+	
+# Otsu's thresholding
+stack = OperationStack()
+stack.add_operation(thresholds[3])
+stack.add_operation(BitwiseNotOperation())	
+
+# cleanup by dilating
+#stack.add_operation(MorphologicalOperation(Morph.OPENING, kernelSize = 5))
+stack.add_operation(MorphologicalOperation(Morph.DILATION, kernelSize = 3))
+
+# we only need the final image, so the processer is free to fuse ops,
+# and it reuses the same two frame buffers for every image
+processer = ImageProcesser(stack, None, step_disk_cache, keep_intermediates = False)
+
+# images are read by Tesseract in batches, one process per batch, so its model is loaded once per batch
+stop = False
+for batch_start in range(0, len(dataset), ocr_batch_size):
+	cleaned_imgs = []
+	for file in dataset[batch_start:batch_start + ocr_batch_size]:
+		# load image in color and let the processer convert it, 
+		# the same way the StackEditor does (so they share disk cache entries)
+		img = cv2.imread(file,cv2.IMREAD_COLOR)
+		"""
+		# Canny edge detection
+		edges = cv2.Canny(img,100,200)
+	
+		# dilate to make edges thicker
+		kernel = np.ones((3,3),np.uint8)
+		dilation = cv2.dilate(edges,kernel,iterations = 1)
+	
+		# Hough line transform
+		minLineLength = math.floor(0.5 * img.shape[0])
+		lines = cv2.HoughLines(dilation,5,np.pi/2,minLineLength)	# image, pixel pos resolution, angular resolution, threshold (min length)
+	
+		# draw the lines on the img
+		backtorgb = cv2.cvtColor(dilation, cv2.COLOR_GRAY2RGB)
+		linelen = 1000
+		if lines is not None:
+			for rho,theta in [line[0] for line in lines]:
+				a = np.cos(theta)
+				b = np.sin(theta)
+				x0 = a*rho
+				y0 = b*rho 
+				x1 = int(x0 + linelen*(-b))
+				y1 = int(y0 + linelen*(a))
+				x2 = int(x0 - linelen*(-b))
+				y2 = int(y0 - linelen*(a))
 			
-			# img, pt1, pt2, color, thickness
-			#cv2.circle(edges, 
-			cv2.line(backtorgb,(x1,y1),(x2,y2),(0,255,0),1)
-	"""
-	
-	# binary thresholding followed by morphological cleanup
-	thresholds = [
-	ThresholdOperation().set_threshold(127, cv2.THRESH_BINARY),
-	ThresholdOperation().set_adaptive_threshold(cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2),
-	ThresholdOperation().set_adaptive_threshold(cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2),
-		
-	# Otsu's thresholding
-	ThresholdOperation().set_threshold(0, cv2.THRESH_BINARY+cv2.THRESH_OTSU),
-	]
-		
-	# Otsu's thresholding after Gaussian filtering
-	#ip2 = ImageProcesser()
-	#ip2.add_operation(BlurOperation(kernelSize = 5))
-	#ip2.add_operation(thresholds[3])
+				# img, pt1, pt2, color, thickness
+				#cv2.circle(edges, 
+				cv2.line(backtorgb,(x1,y1),(x2,y2),(0,255,0),1)
+		"""
 		
-	# Otsu's thresholding
-	stack = OperationStack()
-	stack.add_operation(thresholds[3])
-	stack.add_operation(BitwiseNotOperation())	
-
-	# cleanup by dilating
-	#stack.add_operation(MorphologicalOperation(Morph.OPENING, kernelSize = 5))
-	stack.add_operation(MorphologicalOperation(Morph.DILATION, kernelSize = 3))
-	
-	cleaned_img = ImageProcesser(stack).process_image(img)
+		# the processer reuses its buffers, so each image in the batch needs its own copy
+		cleaned_imgs.append(np.copy(processer.process_color_image(img)))
+		if DEBUG:
+			processer.dump_plan()
 	
-	# read processed image using tesseract
-	boxes = text_reader.read_image(cleaned_img)
+	# read processed images using tesseract
+	if tesseract_pool is not None:
+		all_boxes = [read_image_in_bands(tesseract_pool, cleaned_img) for cleaned_img in cleaned_imgs]
+	else:
+		all_boxes = text_reader.read_images(cleaned_imgs)
 	
-	# Draw the bounding box
-	data_vis = TesseractDataVisualizer()
-	bounds_img = data_vis.draw_text_bounds(boxes, cleaned_img)
+	for cleaned_img, boxes in zip(cleaned_imgs, all_boxes):
+		# Draw the bounding box
+		data_vis = TesseractDataVisualizer()
+		bounds_img = data_vis.draw_text_bounds(boxes, cleaned_img)
 	
-	#resize
-	resizer = ImageResizer(bounds_img.shape)
-	resizer.set_new_width(400)
+		#resize
+		resizer = ImageResizer(bounds_img.shape)
+		resizer.set_new_width(400)
 	
-	small_boxes = resizer.resize_tesseract_data(boxes)
-	imgSmall = resizer.resize_image(bounds_img)
+		small_boxes = resizer.resize_tesseract_data(boxes)
+		imgSmall = resizer.resize_image(bounds_img)
 	
-	cv2.imshow('image',imgSmall)
+		cv2.imshow('image',imgSmall)
 	
-	# create a representation of the tesseract data
-	white_img = resizer.create_new_image_at_size()
-	cvReconImg = data_vis.draw_text_chars(small_boxes, white_img)
+		# create a representation of the tesseract data
+		white_img = resizer.create_new_image_at_size()
+		cvReconImg = data_vis.draw_text_chars(small_boxes, white_img)
 	
-	cv2.imshow('reconstruction',cvReconImg)
+		cv2.imshow('reconstruction',cvReconImg)
 	
 	
-	#print("\n" + file)
-	#print(pytesseract.image_to_string(cv2_im))
+		#print("\n" + file)
+		#print(pytesseract.image_to_string(cv2_im))
 	
 	
-	# wait for key press or window close
-	# pressing Escape will skip all remaining images
-	stop = False
-	while cv2.getWindowProperty('image', 0) >= 0:
-		keyCode = cv2.waitKey(50)
-		if keyCode == 27:
-			stop = True
-		if keyCode >= 0:
+		# wait for key press or window close
+		# pressing Escape will skip all remaining images
+		while cv2.getWindowProperty('image', 0) >= 0:
+			keyCode = cv2.waitKey(50)
+			if keyCode == 27:
+				stop = True
+			if keyCode >= 0:
+				break
+		cv2.destroyAllWindows()
+		if stop:
 			break
-	cv2.destroyAllWindows()
 	if stop:
 		break
 	#break
@@ -10,9 +10,17 @@ except ImportError:
 	from PIL import Image, ImageDraw
 # --------------
 from enum import Enum
+import copy
+import json
 import re
 
-from rrUtilities.TypeHelpers import is_int
+from rrUtilities.TypeHelpers import is_int, is_float
+from rrUtilities.ResultCache import chain_key, fingerprint_image
+from rrUtilities.StackOptimizer import build_execution_plan, get_source_ops, describe_plan
+import rrUtilities.MorphologyEngine as MorphologyEngine
+from rrUtilities.ImageResizer import ImageResizer
+from rrUtilities.OcrData import transform_boxes
+from rrUtilities.InkDetection import binarize_ink, shrink_for_analysis, binarize_for_analysis
 
 
 #TODO clean up parameters so there isn't so much copy-pasting of getters/setters
@@ -21,6 +29,20 @@ from rrUtilities.TypeHelpers import is_int
 OPERATION_TYPES = {}
 # used for potentially versioning save files in the future
 VERSION = "0.0.1"
+# every 8-bit value once, for building the lookup tables of point-wise ops
+LUT_RAMP = np.arange(256, dtype = np.uint8).reshape(1, 256)
+# bump this whenever an operation produces different output for the same parameters,
+# so old entries in the on-disk step cache are no longer used
+OP_SEMANTICS_VERSION = 1
+# salt for DiskCaches holding step results (OpenCV upgrades can change results too)
+STEP_CACHE_SALT = "ops{0}|cv{1}".format(OP_SEMANTICS_VERSION, cv2.__version__)
+
+# maps OCR boxes read from the output of a run back to the run's input image,
+# given the geometry of its steps (see ImageProcesser.get_last_step_geometry)
+def map_boxes_to_input(boxes, step_geometry):
+	for op, input_shape, output_shape, geometry in reversed(step_geometry):
+		boxes = op.map_boxes_to_input(boxes, input_shape, output_shape, geometry)
+	return boxes
 
 def deserialize_op_type(type_str):
 	if type_str in OPERATION_TYPES:
@@ -85,6 +107,10 @@ class OperationParameter:
 	def deserialize(self, data):
 		self.setter(data[1])
 		
+# scales an odd kernel size (blur, morphology, threshold blocks...) by scale, keeping it odd and at least minimum
+def scale_kernel_size(size, scale, minimum = 1):
+	return max(minimum, int(round(size * scale)) | 1)
+
 # ImageOperations are CV (computer vision) steps in the OperationStack
 class ImageOperation:
 
@@ -99,8 +125,13 @@ class ImageOperation:
 		self.label = self.get_default_label()
 		self.muted = False
 		self.parameters = []
+		# see get_geometry
+		self.lastGeometry = None
 
-	def apply_to_image(self, img):
+	# If dst is given, it's a preallocated array with the same shape and dtype as img (and never img itself).
+	# Ops can write their output into it and return it, or ignore it and return a new array
+	# (e.g. if the output has a different size).
+	def apply_to_image(self, img, dst = None):
 		print("WARNING: Base apply_to_image function has been called on ImageOperation, something is probably wrong")
 		return img
 		
@@ -121,11 +152,73 @@ class ImageOperation:
 	
 	def get_parameters(self):
 		return self.parameters
+		
+	# -- hooks for the StackOptimizer --
+	# True if the op, with its current parameters, returns its input unchanged
+	def is_identity(self):
+		return False
+		
+	# Ops whose output pixel only depends on the input pixel (threshold, not, gamma, contrast, clamp...)
+	# can return their 256-entry uint8 lookup table here. Runs of these ops get fused into a single
+	# cv2.LUT pass. Returns None if the op isn't point-wise (with its current parameters).
+	def get_lookup_table(self):
+		return None
+		
+	# returns the list of ops that does the same as self followed by next_op ([] if they cancel out),
+	# or None if the two can't be fused. Must not modify self or next_op (they belong to the stack).
+	def fuse_with(self, next_op):
+		table = self.get_lookup_table()
+		if table is None:
+			return None
+		next_table = next_op.get_lookup_table()
+		if next_table is None:
+			return None
+			
+		fused = LookupTableOperation(next_table[table])
+		if fused.is_identity():
+			return []
+		return [fused]
+
+	# Ops that move pixels around (e.g. TextScaleOperation) map OCR boxes (a BOX_DTYPE array) read from
+	# their output back to their input. The shapes are those of the images the op ran on,
+	# and geometry is what get_geometry returned for the input.
+	def map_boxes_to_input(self, boxes, input_shape, output_shape, geometry):
+		return boxes
+		
+	# Ops whose transform depends on the image (e.g. the angle DeskewOperation finds) return it here,
+	# for map_boxes_to_input. apply_to_image leaves the geometry it used in self.lastGeometry,
+	# which the processer caches next to the step's output, so this is only a fallback for old cache entries.
+	def get_geometry(self, img):
+		return None
+		
+	# whether the op has a geometry (see get_geometry) worth caching
+	def has_geometry(self):
+		return False
+		
+	# Ops that find something in the image (e.g. the receipt ReceiptCropOperation crops to) can return
+	# a copy of their input with it drawn on, for the stack editor to show. None means there's nothing to show.
+	def draw_overlay(self, img):
+		return None
+		
+	# whether draw_overlay is worth calling
+	def has_overlay(self):
+		return False
+		
+	# Returns an op that does to an image downscaled by scale (< 1) what this op does to the full image,
+	# for quick previews. Ops with sizes in pixels return a copy with them scaled; the rest return themselves.
+	def get_proxy_operation(self, scale):
+		return self
+
+	# returns a string that changes whenever a property that affects the output image changes
+	# (the label and the muted flag are left out on purpose)
+	def get_fingerprint(self):
+		return json.dumps([type(self).__name__, self.serialize()[self.KEY_PROPS]], sort_keys = True)
 
 	def serialize(self):
 		props = {}
 		
-		for param in self.parameters:
+		# get_parameters includes parameters that are only shown in some modes (e.g. adaptive threshold)
+		for param in self.get_parameters():
 			entry = param.serialize()
 			props[entry[0]] = entry[1]
 		
@@ -139,7 +232,7 @@ class ImageOperation:
 		self.set_label(data[self.KEY_LABEL])
 		self.muted = data[self.KEY_MUTED]
 		for prop_key, prop_val in data[self.KEY_PROPS].items():
-			for param in self.parameters:
+			for param in self.get_parameters():
 				param_key = param.serialize()[0]
 				if param_key == prop_key:
 					param.deserialize([prop_key, prop_val])
@@ -184,6 +277,13 @@ class OperationStack:
 
 	def get_stack(self):
 		return self.op_stack
+		
+	# a stack of the proxy versions of these ops (see ImageOperation.get_proxy_operation),
+	# for running on a copy of the image downscaled by scale
+	def get_proxy_stack(self, scale):
+		proxy_stack = OperationStack()
+		proxy_stack.op_stack = [op.get_proxy_operation(scale) for op in self.op_stack]
+		return proxy_stack
 
 	def swap_ops(self, a, b):
 		if a < 0 or a >= len(self.op_stack):
@@ -227,33 +327,208 @@ class OperationStack:
 
 
 # The ImageProcessor is a helper class that applies an OperationStack to a cv2 image
+# If it is given a cache (see ResultCache.MemoryCache), the output of every step is stored
+# under a key made from the input image and the parameters of every op up to that step.
+# Changing the op at index k then only recomputes steps k..n.
+# A disk_cache (see ResultCache.DiskCache, salted with STEP_CACHE_SALT) does the same across runs.
+#
+# The stack is run through the StackOptimizer first. With keep_intermediates, every step's output
+# is in the results (what the editor needs), so only dead ops are skipped.
+# Without it (headless/batch use), ops are also fused, and the processer only holds the current frame:
+# ops write into two preallocated buffers in turn, which are reused by the next call if the size matches.
+# In that mode the returned image is one of those buffers, so copy it if you need it past the next call.
 class ImageProcesser:
 
-	def __init__(self, stack = None):
+	def __init__(self, stack = None, cache = None, disk_cache = None, keep_intermediates = True):
 		if stack:
 			self.op_stack = stack
 		else:
 			self.op_stack = OperationStack()
+		self.cache = cache
+		self.disk_cache = disk_cache
+		self.keep_intermediates = keep_intermediates
 		self.results = []
+		self.plan = []
+		# [op, input shape, output shape, geometry] for every op that ran in the last process_image call
+		self.step_geometry = []
+		self.buffers = [None, None]
+		# called between ops; when it returns True, process_image gives up (see StackThreadManager)
+		self.cancel_check = None
 	
 	def add_operation(self, operation, label = None):
 		self.op_stack.add_operation(operation, label)
+		
+	def fingerprint(self, img):
+		if self.cache is not None:
+			return self.cache.fingerprint(img)
+		return fingerprint_image(img)
+	
+	# checks the memory cache, then the disk cache
+	def lookup(self, key):
+		img = None
+		if self.cache is not None:
+			img = self.cache.get(key)
+			
+		if self.disk_cache is not None:
+			if img is None:
+				img = self.disk_cache.get(key)
+				if img is not None and self.cache is not None:
+					self.cache.put(key, img)
+			elif not self.disk_cache.contains(key):
+				# computed by a run that didn't write to disk (e.g. a slider drag in the editor)
+				self.disk_cache.put(key, img)
+		return img
+		
+	def store(self, key, img):
+		# the ping-pong buffers get overwritten, so they can't be kept in memory
+		if self.cache is not None and not self.is_buffer(img):
+			self.cache.put(key, img)
+		if self.disk_cache is not None:
+			self.disk_cache.put(key, img)
+			
+	# A step's geometry is cached as a small array under its own key, derived from the step's,
+	# so a cache hit doesn't have to estimate it again from the input.
+	def get_geometry_key(self, key):
+		return chain_key(key, "geometry")
+		
+	def lookup_geometry(self, key):
+		geometry = self.lookup(self.get_geometry_key(key))
+		if geometry is not None and geometry.ndim == 0:
+			return geometry.item()
+		return geometry
+		
+	def store_geometry(self, key, geometry):
+		self.store(self.get_geometry_key(key), np.array(geometry, dtype = np.float64))
+			
+	def is_buffer(self, img):
+		return any(img is buffer for buffer in self.buffers)
+			
+	# returns the ping-pong buffer at index, (re)allocated to match shape and dtype
+	def get_buffer(self, index, shape, dtype):
+		buffer = self.buffers[index]
+		if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+			buffer = np.empty(shape, dtype = dtype)
+			self.buffers[index] = buffer
+		return buffer
+		
+	# the buffer an op should write to next, which is never the one holding its input
+	def get_next_buffer(self, img):
+		index = 1 if img is self.buffers[0] else 0
+		return self.get_buffer(index, img.shape, img.dtype)
+	
+	# with neither cache there's nothing to look keys up in, so we don't spend time hashing frames
+	def is_caching(self):
+		return self.cache is not None or self.disk_cache is not None
 	
 	def process_color_image(self, img):
-		self.process_image(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+		key = None
+		if self.is_caching():
+			key = chain_key(self.fingerprint(img), "COLOR_BGR2GRAY")
+		
+		# converting is about as fast as reading it back from disk, so this only goes in memory
+		gray = self.cache.get(key) if self.cache is not None else None
+		if gray is None:
+			if self.keep_intermediates:
+				gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+				if self.cache is not None:
+					self.cache.put(key, gray)
+			else:
+				gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst = self.get_buffer(0, img.shape[:2], img.dtype))
+				
+		return self.process_image(gray, key)
 	
-	def process_image(self, img):
-		results = [[img, "Original"]]
+	# each entry in the results is [image, label, key] (the key is None when the processer has no cache).
+	# Returns None (and leaves no results) if cancel_check cancelled the run.
+	def process_image(self, img, key = None):
+		if key is None and self.is_caching():
+			key = self.fingerprint(img)
+		
+		ops = self.op_stack.get_stack()
+		self.plan = build_execution_plan(ops, self.keep_intermediates)
+			
+		results = [[img, "Original", key]]
+		self.step_geometry = []
 		temp = img
-		for op in self.op_stack.get_stack():
-			if not op.muted:
-				temp = op.apply_to_image(temp)
-			results.append([temp, op.get_label()])
+		# the key of the last stack step whose output we've reached
+		stack_key = key
+		for index, step in enumerate(self.plan):
+			if self.cancel_check is not None and self.cancel_check():
+				self.results = None
+				return None
+				
+			# ops the plan skipped don't change the image, so they don't change the key either
+			while self.keep_intermediates and len(results) <= step.last:
+				results.append([temp, ops[len(results) - 1].get_label(), key])
+		
+			cached = None
+			if key is not None:
+				# A step is keyed by the stack ops it stands in for, not by its own op, so fused and unfused
+				# runs of a stack share cache entries. When a fusion produced several ops, the ones before
+				# the last produce images no stack step does, so they're keyed by their own op instead.
+				next_step = self.plan[index + 1] if index + 1 < len(self.plan) else None
+				if next_step is not None and next_step.first == step.first and next_step.last == step.last:
+					key = chain_key(key, step.op.get_fingerprint())
+				else:
+					key = stack_key
+					for op in get_source_ops(ops, step):
+						key = chain_key(key, op.get_fingerprint())
+					stack_key = key
+				cached = self.lookup(key)
+			input_shape = temp.shape
+			
+			if cached is not None:
+				geometry = None
+				if step.op.has_geometry():
+					geometry = self.lookup_geometry(key)
+					if geometry is None:
+						geometry = step.op.get_geometry(temp)
+						if geometry is not None:
+							self.store_geometry(key, geometry)
+				temp = cached
+			else:
+				prev = temp
+				step.op.lastGeometry = None
+				if self.keep_intermediates:
+					temp = step.op.apply_to_image(temp)
+				else:
+					temp = step.op.apply_to_image(temp, self.get_next_buffer(temp))
+				geometry = step.op.lastGeometry
+				# ops like NullOperation hand back their input, which we don't own
+				if temp is not prev and key is not None:
+					self.store(key, temp)
+					if geometry is not None:
+						self.store_geometry(key, geometry)
+			self.step_geometry.append([step.op, input_shape, temp.shape, geometry])
+				
+			if self.keep_intermediates:
+				results.append([temp, ops[step.last].get_label(), key])
+		
+		if self.keep_intermediates:
+			while len(results) <= len(ops):
+				results.append([temp, ops[len(results) - 1].get_label(), key])
+		else:
+			# only the current frame
+			results = [[temp, ops[-1].get_label() if ops else "Original", key]]
+			
 		self.results = results
 		return temp
 		
 	def get_last_results(self):
 		return self.results
+		
+	def get_last_step_geometry(self):
+		return self.step_geometry
+		
+	# maps OCR boxes read from the last processed image back to the coordinates of its input
+	def map_boxes_to_input(self, boxes):
+		return map_boxes_to_input(boxes, self.step_geometry)
+		
+	# the plan that actually ran in the last process_image call (see StackOptimizer)
+	def get_last_plan(self):
+		return self.plan
+		
+	def dump_plan(self):
+		print(describe_plan(self.plan, self.op_stack.get_stack()))
 
 
 
@@ -267,9 +542,12 @@ class ImageProcesser:
 
 
 class NullOperation(ImageOperation):
-	def apply_to_image(self, img):
+	def apply_to_image(self, img, dst = None):
 		return img
 		
+	def is_identity(self):
+		return True
+		
 	@staticmethod
 	def get_type_label():
 		return "Null Operation"
@@ -278,9 +556,45 @@ class NullOperation(ImageOperation):
 		return "None"
 
 
+# Applies a 256-entry lookup table. The StackOptimizer creates these when it fuses point-wise ops,
+# so it isn't in OPERATION_TYPES (there's no way to edit the table in the UI)
+class LookupTableOperation(ImageOperation):
+	def __init__(self, table):
+		super(LookupTableOperation, self).__init__()
+		self.table = table
+		
+	def apply_to_image(self, img, dst = None):
+		return cv2.LUT(img, self.table, dst = dst)
+		
+	def get_lookup_table(self):
+		return self.table
+		
+	def is_identity(self):
+		return np.array_equal(self.table, LUT_RAMP.ravel())
+		
+	def get_fingerprint(self):
+		return "LookupTableOperation|{0}".format(fingerprint_image(self.table))
+		
+	@staticmethod
+	def get_type_label():
+		return "Lookup Table Operation"
+		
+	def get_default_label(self):
+		return "Lookup Table"
+
+
 class BitwiseNotOperation(ImageOperation):
-	def apply_to_image(self, img):
-		return cv2.bitwise_not(img)
+	def apply_to_image(self, img, dst = None):
+		return cv2.bitwise_not(img, dst = dst)
+		
+	def get_lookup_table(self):
+		return self.apply_to_image(LUT_RAMP).ravel()
+		
+	def fuse_with(self, next_op):
+		# not(not(x)) == x
+		if type(next_op) is BitwiseNotOperation:
+			return []
+		return super(BitwiseNotOperation, self).fuse_with(next_op)
 		
 	@staticmethod
 	def get_type_label():
@@ -429,6 +743,34 @@ Normally, it is positive but may be zero or negative as well.
 			return self.parameters + self.normalParams
 		
 	
+	# maxValue has no UI parameter, so it isn't part of the serialized props,
+	# and types combined with flags (e.g. THRESH_BINARY+THRESH_OTSU) serialize as "NONE"
+	def get_fingerprint(self):
+		return "{0}|max={1}|type={2}".format(super(ThresholdOperation, self).get_fingerprint(), self.maxValue, self.thresholdType)
+	
+	def fuse_with(self, next_op):
+		# a binary threshold followed by a not is the inverted binary threshold (and vice versa),
+		# as long as the output is 0 or 255. This holds for the adaptive and Otsu modes too.
+		if type(next_op) is BitwiseNotOperation and self.maxValue == 255:
+			baseType = self.thresholdType & cv2.THRESH_MASK
+			invertedType = None
+			if baseType == cv2.THRESH_BINARY:
+				invertedType = cv2.THRESH_BINARY_INV
+			elif baseType == cv2.THRESH_BINARY_INV:
+				invertedType = cv2.THRESH_BINARY
+				
+			if invertedType is not None:
+				fused = copy.deepcopy(self)
+				fused.thresholdType = (self.thresholdType & ~cv2.THRESH_MASK) | invertedType
+				return [fused]
+		return super(ThresholdOperation, self).fuse_with(next_op)
+		
+	# a fixed threshold is point-wise; we let cv2.threshold build the table so the semantics match exactly
+	def get_lookup_table(self):
+		if self.usesAdaptiveMethod or self.usesOtsu or (self.thresholdType & ~cv2.THRESH_MASK):
+			return None
+		return self.apply_to_image(LUT_RAMP).ravel()
+	
 	def set_output_value(self, pMaxValue):
 		self.maxValue = pMaxValue
 		
@@ -462,25 +804,35 @@ Normally, it is positive but may be zero or negative as well.
 		
 		return self
 		
-	def apply_to_image(self, img):
+	def get_proxy_operation(self, scale):
+		if not self.usesAdaptiveMethod:
+			return self
+		proxy = copy.deepcopy(self)
+		proxy.blockSize = scale_kernel_size(self.blockSize, scale, 3)
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
 		if self.usesAdaptiveMethod:
 			return cv2.adaptiveThreshold(img,
 				self.maxValue,
 				self.adaptiveMethod,
 				self.thresholdType,
 				self.blockSize,
-				self.C)
+				self.C,
+				dst = dst)
 		else:
 			if self.usesOtsu:
 				return cv2.threshold(img,
 					0,
 					self.maxValue,
-					self.thresholdType+cv2.THRESH_OTSU)[1]
+					self.thresholdType+cv2.THRESH_OTSU,
+					dst = dst)[1]
 			else:
 				return cv2.threshold(img,
 					self.thresholdValue,
 					self.maxValue,
-					self.thresholdType)[1]
+					self.thresholdType,
+					dst = dst)[1]
 
 
 
@@ -565,10 +917,17 @@ pixel extrapolation method (see borderInterpolate() for details).
 	def getKernelSize(self):
 		return self.kernelSize
 		
-	def apply_to_image(self, img):
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.kernelSize = scale_kernel_size(self.kernelSize, scale)
+		proxy.sigma = self.sigma * scale
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
 		return cv2.GaussianBlur(img,
 			(self.kernelSize, self.kernelSize),
-			self.sigma)
+			self.sigma,
+			dst = dst)
 
 
 
@@ -684,36 +1043,563 @@ class MorphologicalOperation(ImageOperation):
 		
 		return self
 	
+	def is_identity(self):
+		return self.type == MorphologicalOperationType.NONE
+	
 	def set_kernel(self, pKernelSize, pShape = cv2.MORPH_RECT):
 		self.kernelSize = pKernelSize
 		self.shape = pShape
 		
 		return self
 		
-	def apply_to_image(self, img):
-		kernel = cv2.getStructuringElement(self.shape,(self.kernelSize,self.kernelSize))
-		#np.ones((self.kernelSize,self.kernelSize),np.uint8)
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.kernelSize = scale_kernel_size(self.kernelSize, scale)
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
+		# MorphologyEngine gives the same results as cv2 with getStructuringElement(shape, (size, size)),
+		# but reuses kernels and has faster paths for rect kernels
 		if self.type == MorphologicalOperationType.EROSION:
-			return cv2.erode(img, kernel, iterations = self.iterations)
+			return MorphologyEngine.erode(img, self.shape, self.kernelSize, self.iterations, dst)
 		elif self.type == MorphologicalOperationType.DILATION:
-			return cv2.dilate(img, kernel, iterations = self.iterations)
+			return MorphologyEngine.dilate(img, self.shape, self.kernelSize, self.iterations, dst)
 		elif self.type == MorphologicalOperationType.OPENING:
-			return cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel)
+			return MorphologyEngine.morphology(img, cv2.MORPH_OPEN, self.shape, self.kernelSize, dst)
 		elif self.type == MorphologicalOperationType.CLOSING:
-			return cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel)
+			return MorphologyEngine.morphology(img, cv2.MORPH_CLOSE, self.shape, self.kernelSize, dst)
 		elif self.type == MorphologicalOperationType.GRADIENT:
-			return cv2.morphologyEx(img, cv2.MORPH_GRADIENT, kernel)
+			return MorphologyEngine.morphology(img, cv2.MORPH_GRADIENT, self.shape, self.kernelSize, dst)
 		else:
 			print ("WARNING: MorphologicalOperation was applied with an inoperable type: {}".format(self.type))
 			return img
 
 
+# the height Tesseract reads text best at, in pixels (it likes capitals around 30px tall)
+DEFAULT_TEXT_HEIGHT = 30
+# glyph sizes are measured on a copy downscaled to about this many pixels
+TEXT_SCALE_ANALYSIS_SIZE = 1600
+# with fewer glyph-like components than this, we don't trust the estimate and leave the image alone
+MIN_GLYPH_COUNT = 10
+
+# Estimates the typical glyph height of img from the connected components of a small, Otsu-binarized copy.
+# Returns the height in img's pixels, or None if there isn't enough text to tell.
+def estimate_text_height(img):
+	ink = binarize_for_analysis(img, TEXT_SCALE_ANALYSIS_SIZE)
+	count, labels, stats, centroids = cv2.connectedComponentsWithStats(ink, connectivity = 8)
+	widths = stats[1:, cv2.CC_STAT_WIDTH]
+	heights = stats[1:, cv2.CC_STAT_HEIGHT]
+	# skip specks, and things too big or too wide to be glyphs (borders, lines, logos)
+	glyphs = (heights >= 3) & (heights <= ink.shape[0] // 4) & (widths <= heights * 4)
+	if np.count_nonzero(glyphs) < MIN_GLYPH_COUNT:
+		return None
+	return float(np.median(heights[glyphs])) * img.shape[0] / ink.shape[0]
+
+# Rescales the image so its text ends up about textHeight pixels tall.
+# Full resolution phone photos have text far bigger than Tesseract needs, so this mostly shrinks them,
+# which makes OCR (and every op after this one) faster. Small text is enlarged, up to maxScale.
+class TextScaleOperation(ImageOperation):
+
+	MIN_SCALE = 0.1
+	# scales this close to 1 aren't worth a resize
+	SCALE_TOLERANCE = 0.05
+
+	@staticmethod
+	def get_type_label():
+		return "Text Scale Operation"
+		
+	def get_default_label(self):
+		return "Text Scale"
+		
+	def __init__(self, textHeight = DEFAULT_TEXT_HEIGHT):
+		super(TextScaleOperation, self).__init__()
+		
+		self.textHeight = textHeight
+		self.maxScale = 2
+		
+		self.parameters.append(
+		OperationParameter("Text Height", self.getTextHeight, self.callback_setTextHeight).set_slider(10, 60, 5))
+		
+		self.parameters.append(
+		OperationParameter("Max Scale", self.getMaxScale, self.callback_setMaxScale).set_slider(1, 4, 1))
+		
+	def callback_setTextHeight(self, val):
+		if is_int(val) and int(val) > 0: self.textHeight = int(val)
+	def callback_setMaxScale(self, val):
+		if is_int(val) and int(val) >= 1: self.maxScale = int(val)
+		
+	def getTextHeight(self):
+		return self.textHeight
+	def getMaxScale(self):
+		return self.maxScale
+		
+	# the factor apply_to_image scales img by
+	def get_scale(self, img):
+		text_height = estimate_text_height(img)
+		if text_height is None:
+			return 1.0
+		scale = min(max(self.textHeight / text_height, self.MIN_SCALE), self.maxScale)
+		if abs(scale - 1.0) < self.SCALE_TOLERANCE:
+			return 1.0
+		return scale
+		
+	# the target text height is in pixels of the image, so it shrinks with the image
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.textHeight = self.textHeight * scale
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
+		scale = self.get_scale(img)
+		if scale == 1.0:
+			return img
+		height, width = img.shape[:2]
+		size = (max(1, round(width * scale)), max(1, round(height * scale)))
+		return cv2.resize(img, size, interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC)
+		
+	def map_boxes_to_input(self, boxes, input_shape, output_shape, geometry):
+		if input_shape[:2] == output_shape[:2]:
+			return boxes
+		resizer = ImageResizer(output_shape)
+		resizer.set_new_size(input_shape[1], input_shape[0])
+		return resizer.resize_tesseract_data(boxes)
+
+
+# the skew is measured on a copy downscaled so its longest side is about this long
+DESKEW_ANALYSIS_SIZE = 800
+# at most this many ink pixels are projected per angle
+DESKEW_MAX_POINTS = 50000
+# with fewer ink pixels than this, there's no text to line up and the image is left alone
+DESKEW_MIN_INK = 500
+# angles smaller than this (in degrees) aren't worth a rotation
+DESKEW_MIN_ANGLE = 0.2
+
+# Scores each angle (in degrees) by how sharply the points line up in rows once rotated by it:
+# the sum of squares of the row histogram, which is largest when text lines fall in as few rows as possible.
+# All the angles are projected at once, with their histograms side by side in a single bincount.
+def get_projection_scores(xs, ys, angles):
+	radians = np.deg2rad(angles)
+	rows = np.rint(np.outer(np.cos(radians), ys) - np.outer(np.sin(radians), xs)).astype(np.int64)
+	rows -= rows.min(axis = 1, keepdims = True)
+	span = int(rows.max()) + 1
+	rows += (np.arange(len(angles)) * span)[:, np.newaxis]
+	counts = np.bincount(rows.ravel(), minlength = len(angles) * span).reshape(len(angles), span)
+	return np.sum(counts.astype(np.float64) ** 2, axis = 1)
+
+# Estimates how far (in degrees, within max_angle) img has to be rotated counterclockwise to level its text,
+# from the projection profile of a small, Otsu-binarized copy. Searches in 0.5 degree steps, then 0.1 around the best.
+# Returns 0.0 if there isn't enough ink to tell.
+def estimate_skew_angle(img, max_angle):
+	ink = binarize_for_analysis(img, DESKEW_ANALYSIS_SIZE)
+	ys, xs = np.nonzero(ink)
+	if len(xs) < DESKEW_MIN_INK:
+		return 0.0
+	stride = -(-len(xs) // DESKEW_MAX_POINTS)
+	xs = xs[::stride].astype(np.float64) - ink.shape[1] / 2
+	ys = ys[::stride].astype(np.float64) - ink.shape[0] / 2
+	
+	angles = np.arange(-max_angle, max_angle + 0.25, 0.5)
+	best = angles[np.argmax(get_projection_scores(xs, ys, angles))]
+	angles = np.clip(best + np.arange(-0.4, 0.45, 0.1), -max_angle, max_angle)
+	best = angles[np.argmax(get_projection_scores(xs, ys, angles))]
+	return float(np.round(best, 1))
+
+# Rotates the image to level its lines of text, which Tesseract reads much better than slanted ones.
+# The angle is found from the image itself (see estimate_skew_angle), up to maxAngle degrees either way.
+# The image keeps its size, with the corners filled in from the nearest edge pixels.
+class DeskewOperation(ImageOperation):
+
+	@staticmethod
+	def get_type_label():
+		return "Deskew Operation"
+		
+	def get_default_label(self):
+		return "Deskew"
+		
+	def __init__(self, maxAngle = 10):
+		super(DeskewOperation, self).__init__()
+		
+		self.maxAngle = maxAngle
+		
+		self.parameters.append(
+		OperationParameter("Max Angle", self.getMaxAngle, self.callback_setMaxAngle).set_slider(1, 30, 1))
+		
+	def callback_setMaxAngle(self, val):
+		if is_int(val) and int(val) > 0: self.maxAngle = int(val)
+		
+	def getMaxAngle(self):
+		return self.maxAngle
+		
+	# the counterclockwise rotation (in degrees) apply_to_image uses on img
+	def get_geometry(self, img):
+		angle = estimate_skew_angle(img, self.maxAngle)
+		if abs(angle) < DESKEW_MIN_ANGLE:
+			return 0.0
+		return angle
+		
+	def has_geometry(self):
+		return True
+		
+	def get_rotation_matrix(self, shape, angle):
+		height, width = shape[:2]
+		return cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+		
+	def apply_to_image(self, img, dst = None):
+		angle = self.get_geometry(img)
+		self.lastGeometry = angle
+		if angle == 0.0:
+			return img
+		height, width = img.shape[:2]
+		return cv2.warpAffine(img, self.get_rotation_matrix(img.shape, angle), (width, height), dst = dst,
+			flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+		
+	def map_boxes_to_input(self, boxes, input_shape, output_shape, geometry):
+		if not geometry:
+			return boxes
+		matrix = cv2.invertAffineTransform(self.get_rotation_matrix(input_shape, geometry))
+		return transform_boxes(boxes, matrix, output_shape[0], input_shape[0])
+
+
+# the receipt is searched for on a copy downscaled so its longest side is about this long
+RECEIPT_ANALYSIS_SIZE = 500
+# a receipt has to cover at least this fraction of the image, or we don't trust what we found
+RECEIPT_MIN_AREA = 0.1
+# and if it covers more than this, it already fills the frame (or the image is blank), so there's nothing to cut
+RECEIPT_MAX_AREA = 0.9
+
+# puts the corners of a quadrilateral in the order top left, top right, bottom right, bottom left
+def order_quad_corners(quad):
+	sums = quad.sum(axis = 1)
+	diffs = quad[:, 1] - quad[:, 0]
+	return np.array([quad[np.argmin(sums)], quad[np.argmin(diffs)], quad[np.argmax(sums)], quad[np.argmax(diffs)]], dtype = np.float32)
+
+# Finds the receipt (the largest bright region) in img, on a small copy, and returns its four corners
+# in img's coordinates (see order_quad_corners), or None if there's no receipt smaller than the image to cut to.
+# If its outline doesn't simplify to four points, the smallest rotated rectangle around it is used.
+def find_receipt_quad(img):
+	height, width = img.shape[:2]
+	small = cv2.GaussianBlur(shrink_for_analysis(img, RECEIPT_ANALYSIS_SIZE), (5, 5), 0)
+	# the paper is the bright class, however much of the frame it covers
+	paper = binarize_ink(small, dark_ink = False)[0]
+	# fill in the text, so the paper is one solid region
+	paper = cv2.morphologyEx(paper, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+	contours = cv2.findContours(paper, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+	if not contours:
+		return None
+	contour = max(contours, key = cv2.contourArea)
+	area = cv2.contourArea(contour)
+	if area < RECEIPT_MIN_AREA * paper.size or area > RECEIPT_MAX_AREA * paper.size:
+		return None
+	
+	quad = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+	if len(quad) == 4:
+		quad = quad.reshape(4, 2).astype(np.float32)
+	else:
+		quad = cv2.boxPoints(cv2.minAreaRect(contour))
+	# from the small copy's pixel grid back to img's
+	quad = (quad + 0.5) * [width / paper.shape[1], height / paper.shape[0]] - 0.5
+	return order_quad_corners(quad)
+
+# Cuts the image down to just the receipt (see find_receipt_quad), so the ops after this one,
+# and Tesseract, don't spend their time on the table it was photographed on.
+# "Warp" maps the receipt's corners to a rectangle, which also undoes perspective and rotation;
+# "Crop" just keeps the upright rectangle around it. Either way, margin pixels of background are kept around it.
+class ReceiptCropOperation(ImageOperation):
+
+	MODES = ["Warp", "Crop"]
+
+	@staticmethod
+	def get_type_label():
+		return "Receipt Crop Operation"
+		
+	def get_default_label(self):
+		return "Receipt Crop"
+		
+	def __init__(self, mode = "Warp", margin = 10):
+		super(ReceiptCropOperation, self).__init__()
+		
+		self.mode = mode
+		self.margin = margin
+		
+		self.parameters.append(
+		OperationParameter("Mode", self.getMode, self.callback_setMode).set_dropdown(self.MODES))
+		
+		self.parameters.append(
+		OperationParameter("Margin", self.getMargin, self.callback_setMargin).set_slider(0, 50, 5))
+		
+	def callback_setMode(self, val):
+		if val in self.MODES: self.mode = val
+	def callback_setMargin(self, val):
+		if is_int(val) and int(val) >= 0: self.margin = int(val)
+		
+	def getMode(self):
+		return self.mode
+	def getMargin(self):
+		return self.margin
+		
+	# returns [3x3 matrix from img to the output, (width, height) of the output],
+	# or None if no receipt was found
+	def get_transform(self, img):
+		quad = find_receipt_quad(img)
+		if quad is None:
+			return None
+		height, width = img.shape[:2]
+		margin = self.margin
+		
+		if self.mode == "Crop":
+			left = max(0, int(np.floor(quad[:, 0].min())) - margin)
+			top = max(0, int(np.floor(quad[:, 1].min())) - margin)
+			right = min(width, int(np.ceil(quad[:, 0].max())) + 1 + margin)
+			bottom = min(height, int(np.ceil(quad[:, 1].max())) + 1 + margin)
+			matrix = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype = np.float64)
+			return [matrix, (right - left, bottom - top)]
+		
+		top_left, top_right, bottom_right, bottom_left = quad
+		out_width = int(round(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left))))
+		out_height = int(round(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right))))
+		corners = np.array([[0, 0], [out_width - 1, 0], [out_width - 1, out_height - 1], [0, out_height - 1]], dtype = np.float32) + margin
+		matrix = cv2.getPerspectiveTransform(quad, corners)
+		return [matrix, (out_width + 2 * margin, out_height + 2 * margin)]
+		
+	# the 3x3 matrix apply_to_image maps img with, or None if it leaves img as it is
+	def get_geometry(self, img):
+		transform = self.get_transform(img)
+		if transform is None:
+			return None
+		return transform[0]
+		
+	def has_geometry(self):
+		return True
+		
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.margin = int(round(self.margin * scale))
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
+		transform = self.get_transform(img)
+		if transform is None:
+			return img
+		matrix, [width, height] = transform
+		self.lastGeometry = matrix
+		if self.mode == "Crop":
+			# a copy, since the processer may reuse img's buffer
+			left, top = int(-matrix[0, 2]), int(-matrix[1, 2])
+			return np.copy(img[top:top + height, left:left + width])
+		return cv2.warpPerspective(img, matrix, (width, height), flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
+		
+	def map_boxes_to_input(self, boxes, input_shape, output_shape, geometry):
+		if geometry is None:
+			return boxes
+		return transform_boxes(boxes, np.linalg.inv(geometry), output_shape[0], input_shape[0])
+		
+	def has_overlay(self):
+		return True
+		
+	def draw_overlay(self, img):
+		quad = find_receipt_quad(img)
+		if quad is None:
+			return None
+		overlay = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img.copy()
+		thickness = max(2, max(img.shape[:2]) // 300)
+		cv2.polylines(overlay, [np.rint(quad).astype(np.int32)], True, (0, 255, 0), thickness)
+		return overlay
+
+
+# the dynamic range of the standard deviation in Sauvola's formula, for 8 bit images
+SAUVOLA_RANGE = 128.0
+
+# Returns the mean and standard deviation of the window x window neighbourhood around every pixel of img,
+# as float32 arrays. Past the image edges, the windows see the image reflected.
+# Both come from box filters of img and img squared, which cost the same for any window size.
+# The filters run on a float32 copy, since the sums of squares of a large window overflow for 8 bit input.
+def get_local_mean_and_std(img, window):
+	img = np.asarray(img, dtype = np.float32)
+	mean = cv2.boxFilter(img, cv2.CV_32F, (window, window), normalize = True, borderType = cv2.BORDER_REFLECT)
+	variance = cv2.sqrBoxFilter(img, cv2.CV_32F, (window, window), normalize = True, borderType = cv2.BORDER_REFLECT)
+	# E[x^2] - mean^2, in place
+	variance -= mean * mean
+	np.maximum(variance, 0, out = variance)
+	return mean, np.sqrt(variance, out = variance)
+
+# Binarizes the image against a threshold computed from each pixel's neighbourhood, which copes with
+# uneven lighting (shadows, curled paper) far better than one global threshold.
+#	Sauvola: mean * (1 + k * (std / 128 - 1)), usually with k around 0.2 to 0.5
+#	Niblack: mean + k * std, usually with k around -0.2
+# Pixels brighter than their threshold become white. Unlike adaptiveThreshold with a Gaussian window,
+# the cost doesn't grow with the window (see get_local_mean_and_std), so windows can span whole lines of text.
+class LocalThresholdOperation(ImageOperation):
+
+	METHODS = ["Sauvola", "Niblack"]
+	DEFAULT_K = {"Sauvola": 0.2, "Niblack": -0.2}
+
+	@staticmethod
+	def get_type_label():
+		return "Local Threshold Operation"
+		
+	def get_default_label(self):
+		return "Local Threshold"
+		
+	def __init__(self, method = "Sauvola", window = 51):
+		super(LocalThresholdOperation, self).__init__()
+		
+		self.method = method
+		self.window = window
+		self.k = self.DEFAULT_K[method]
+		
+		self.parameters.append(
+		OperationParameter("Method", self.getMethod, self.callback_setMethod).set_dropdown(self.METHODS))
+		
+		self.parameters.append(
+		OperationParameter("Window Size", self.getWindow, self.callback_setWindow).set_slider(3, 301, 2))
+		
+		self.parameters.append(
+		OperationParameter("K", self.getK, self.callback_setK).set_type(ParameterType.NUMBER))
+		
+	def callback_setMethod(self, val):
+		if val in self.METHODS: self.method = val
+	def callback_setWindow(self, val):
+		# windows have a center pixel, so they're odd
+		if is_int(val) and int(val) > 0: self.window = int(val) | 1
+	def callback_setK(self, val):
+		if is_float(val): self.k = float(val)
+		
+	def getMethod(self):
+		return self.method
+	def getWindow(self):
+		return self.window
+	def getK(self):
+		return self.k
+		
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.window = scale_kernel_size(self.window, scale, 3)
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
+		img = img.astype(np.float32)
+		mean, std = get_local_mean_and_std(img, self.window)
+		# the threshold is built in std's buffer
+		threshold = std
+		if self.method == "Niblack":
+			threshold *= self.k
+			threshold += mean
+		else:
+			threshold *= self.k / SAUVOLA_RANGE
+			threshold += 1.0 - self.k
+			threshold *= mean
+		return cv2.compare(img, threshold, cv2.CMP_GT, dst = dst)
+
+
+# Removes the blobs of ink (connected components) whose size or shape doesn't look like text,
+# mostly the specks thermal receipts leave after thresholding, which Tesseract would otherwise try to read.
+# A component is kept if:
+#	minArea <= area (in pixels) <= maxAreaPercent of the image
+#	its bounding box is at most maxAspect times longer than it is wide (or wide than it is long)
+#	its ink fills at least minFillPercent of its bounding box
+# The whole stats table is tested at once, and removed components are painted over with the background.
+# Polarity says which of black or white is the ink; "Auto" picks whichever there is less of.
+class ComponentFilterOperation(ImageOperation):
+
+	POLARITIES = ["Auto", "Dark Ink", "Light Ink"]
+
+	@staticmethod
+	def get_type_label():
+		return "Component Filter Operation"
+		
+	def get_default_label(self):
+		return "Component Filter"
+		
+	def __init__(self, minArea = 8):
+		super(ComponentFilterOperation, self).__init__()
+		
+		self.polarity = "Auto"
+		self.minArea = minArea
+		self.maxAreaPercent = 5
+		self.maxAspect = 20
+		self.minFillPercent = 5
+		
+		self.parameters.append(
+		OperationParameter("Polarity", self.getPolarity, self.callback_setPolarity).set_dropdown(self.POLARITIES))
+		
+		self.parameters.append(
+		OperationParameter("Min Area", self.getMinArea, self.callback_setMinArea).set_slider(0, 200, 5))
+		
+		self.parameters.append(
+		OperationParameter("Max Area %", self.getMaxAreaPercent, self.callback_setMaxAreaPercent).set_slider(1, 100, 5))
+		
+		self.parameters.append(
+		OperationParameter("Max Aspect", self.getMaxAspect, self.callback_setMaxAspect).set_slider(1, 50, 5))
+		
+		self.parameters.append(
+		OperationParameter("Min Fill %", self.getMinFillPercent, self.callback_setMinFillPercent).set_slider(0, 100, 5))
+		
+	def callback_setPolarity(self, val):
+		if val in self.POLARITIES: self.polarity = val
+	def callback_setMinArea(self, val):
+		if is_int(val) and int(val) >= 0: self.minArea = int(val)
+	def callback_setMaxAreaPercent(self, val):
+		if is_int(val) and int(val) > 0: self.maxAreaPercent = int(val)
+	def callback_setMaxAspect(self, val):
+		if is_int(val) and int(val) >= 1: self.maxAspect = int(val)
+	def callback_setMinFillPercent(self, val):
+		if is_int(val) and int(val) >= 0: self.minFillPercent = int(val)
+		
+	def getPolarity(self):
+		return self.polarity
+	def getMinArea(self):
+		return self.minArea
+	def getMaxAreaPercent(self):
+		return self.maxAreaPercent
+	def getMaxAspect(self):
+		return self.maxAspect
+	def getMinFillPercent(self):
+		return self.minFillPercent
+		
+	# True for each component (index 0 is the background, which is always kept) that passes the filter
+	def get_keep_mask(self, stats, image_area):
+		areas = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+		widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+		heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+		aspects = np.maximum(widths, heights) / np.minimum(widths, heights)
+		fills = areas / (widths * heights)
+		keep = ((areas >= self.minArea) & (areas <= image_area * self.maxAreaPercent / 100.0) &
+			(aspects <= self.maxAspect) & (fills >= self.minFillPercent / 100.0))
+		keep[0] = True
+		return keep
+		
+	# areas shrink with the square of the scale; the ratios don't change
+	def get_proxy_operation(self, scale):
+		proxy = copy.deepcopy(self)
+		proxy.minArea = int(round(self.minArea * scale * scale))
+		return proxy
+		
+	def apply_to_image(self, img, dst = None):
+		# "Auto" leaves the polarity to binarize_ink, which takes the smaller class as the ink
+		dark_ink = None if self.polarity == "Auto" else self.polarity == "Dark Ink"
+		ink, dark_ink = binarize_ink(img, dark_ink)
+		count, labels, stats, centroids = cv2.connectedComponentsWithStats(ink, connectivity = 8)
+		keep = self.get_keep_mask(stats, img.shape[0] * img.shape[1])
+		
+		if dst is None:
+			dst = np.empty_like(img)
+		np.copyto(dst, img)
+		if not keep.all():
+			dst[~keep[labels]] = 255 if dark_ink else 0
+		return dst
+
+
 OPERATION_TYPES = {
 	"NullOperation": NullOperation,
 	"BitwiseNotOperation": BitwiseNotOperation,
 	"ThresholdOperation": ThresholdOperation,
 	"BlurOperation": BlurOperation,
 	"MorphologicalOperation": MorphologicalOperation,
+	"TextScaleOperation": TextScaleOperation,
+	"DeskewOperation": DeskewOperation,
+	"ReceiptCropOperation": ReceiptCropOperation,
+	"LocalThresholdOperation": LocalThresholdOperation,
+	"ComponentFilterOperation": ComponentFilterOperation,
 }
 
 #EOF
\ No newline at end of file
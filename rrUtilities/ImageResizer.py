@@ -9,11 +9,14 @@ except ImportError:
 	from PIL import Image
 # --------------
 
+# scale_boxes for the Tesseract data
+from rrUtilities.OcrData import scale_boxes
+
 class ImageResizer:
 	def __init__(self, shape):
 		self.origHeight = shape[0]
 		self.origWidth = shape[1]
-		self.origChannels = shape[2]
+		self.origChannels = shape[2] if len(shape) > 2 else 1
 		
 		self.newWidth = self.origWidth
 		self.newHeight = self.origHeight
@@ -26,17 +29,17 @@ class ImageResizer:
 		self.newHeight = height
 		self.newWidth = round(self.origWidth*self.newHeight/self.origHeight)
 		
+	def set_new_size(self, width, height):
+		self.newWidth = width
+		self.newHeight = height
+		
 	def set_size_multiplier(self, scalar):
 		self.newWidth = scalar * self.origWidth
 		self.newHeight = scalar * self.origHeight
 		
+	# returns a scaled copy of a BOX_DTYPE array
 	def resize_tesseract_data(self, data):
-		new_data = []
-		for b in data:
-			new_data.append(b)
-			new_data[-1][1] = int(b[1])*self.newWidth/self.origWidth
-			new_data[-1][2] = int(b[2])*self.newHeight/self.origHeight
-		return new_data
+		return scale_boxes(data, self.newWidth/self.origWidth, self.newHeight/self.origHeight)
 		
 	def resize_image(self, img):
 		return cv2.resize(img, (self.newWidth, self.newHeight), interpolation = cv2.INTER_AREA)
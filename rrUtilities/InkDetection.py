@@ -0,0 +1,36 @@
+# OpenCV ----
+import cv2
+import numpy as np
+# --------------
+
+# Telling ink from paper, shared by every op that needs to (text scale, deskew, receipt crop,
+# component filter, text bands), so they all agree on which pixels are text.
+# Otsu's threshold splits the image into two classes, and the ink is whichever class is smaller.
+
+# Returns [mask, dark_ink]: mask is 255 where gray has ink, and dark_ink says whether the ink
+# is the dark class. Pass dark_ink to force the polarity instead of picking the smaller class.
+def binarize_ink(gray, dark_ink = None):
+	binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+	if dark_ink is None:
+		dark_ink = cv2.countNonZero(binary) > binary.size // 2
+	if dark_ink:
+		cv2.bitwise_not(binary, binary)
+	return [binary, dark_ink]
+
+# A grayscale copy of img, downscaled (with INTER_AREA) so its longest side is at most max_dim,
+# for estimating things about the whole image cheaply. Its shape tells the caller how much it was scaled by.
+def shrink_for_analysis(img, max_dim):
+	height, width = img.shape[:2]
+	factor = min(1.0, max_dim / max(height, width))
+	small = img
+	if factor < 1.0:
+		small = cv2.resize(img, (max(1, round(width * factor)), max(1, round(height * factor))), interpolation = cv2.INTER_AREA)
+	if small.ndim == 3:
+		small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+	return small
+
+# the ink mask (see binarize_ink) of shrink_for_analysis(img, max_dim)
+def binarize_for_analysis(img, max_dim):
+	return binarize_ink(shrink_for_analysis(img, max_dim))[0]
+
+#EOF
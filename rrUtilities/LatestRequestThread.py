@@ -0,0 +1,100 @@
+import threading
+
+# we use Qt's threading so we can emit signals from the thread
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal as Signal
+
+
+# A background thread that works through requests where only the latest one matters
+# (see StackThreadManager and TesseractThreadManager). A new request replaces any that hasn't started yet,
+# and anything older than the latest request that finishes is stale, so its results are dropped.
+# Subclasses implement process_request, and call self.start() at the end of their __init__.
+class LatestRequestThread (QThread):
+
+	# emits the id of the request that finished; get_results has its results
+	onRequestComplete = Signal(int)
+	# emits the id of a request that failed, and the error
+	onRequestFailed = Signal(int, str)
+
+	def __init__(self, log_name):
+		QThread.__init__(self)
+		# prefix for the log messages
+		self.log_name = log_name
+
+		# everything below is shared with the thread, and guarded by the condition's lock
+		self.condition = threading.Condition()
+		self.pending_request = None # [request id, request]
+		self.latest_request_id = 0
+		self.cached_results = None # [request id, results]
+		self.stopping = False
+
+	def __del__(self):
+		self.stop()
+
+	def stop(self):
+		with self.condition:
+			self.stopping = True
+			self.condition.notify()
+		self.wait()
+
+	def is_latest(self, request_id):
+		with self.condition:
+			return request_id == self.latest_request_id
+
+	# for long requests to check as they go, so they can give up early
+	def is_superseded(self, request_id):
+		with self.condition:
+			return self.stopping or request_id != self.latest_request_id
+
+	# Runs on the thread, and returns the results of request, or None if it gave up because it was superseded.
+	# Exceptions are logged and reported with onRequestFailed, and the thread carries on with the next request.
+	def process_request(self, request_id, request):
+		return None
+
+	def run (self):
+		while True:
+			with self.condition:
+				while self.pending_request is None and not self.stopping:
+					self.condition.wait()
+				if self.stopping:
+					return
+				request_id, request = self.pending_request
+				self.pending_request = None
+
+			try:
+				results = self.process_request(request_id, request)
+			except Exception as error:
+				# a failed request shouldn't take the thread (and every later request) down with it
+				print("WARNING: {0}: Request {1} failed: {2}".format(self.log_name, request_id, error))
+				self.onRequestFailed.emit(request_id, str(error))
+				continue
+
+			if results is None:
+				print("{0}: Request {1} was superseded, cancelled it".format(self.log_name, request_id))
+				continue
+
+			with self.condition:
+				if request_id != self.latest_request_id:
+					print("{0}: Request {1} is stale, dropping it".format(self.log_name, request_id))
+					continue
+				self.cached_results = [request_id, results]
+
+			self.onRequestComplete.emit(request_id)
+
+	# queues request in place of any that hasn't started yet, and returns the id of the new request
+	def start_request(self, request):
+		with self.condition:
+			self.latest_request_id += 1
+			self.pending_request = [self.latest_request_id, request]
+			self.condition.notify()
+			return self.latest_request_id
+
+	# Returns the results of request_id, or None if a newer request has been made since
+	# (its results are on their way, so whoever asked for these can ignore them).
+	def get_results(self, request_id):
+		with self.condition:
+			if request_id != self.latest_request_id or self.cached_results is None or self.cached_results[0] != request_id:
+				return None
+			return self.cached_results[1]
+
+#EOF
@@ -0,0 +1,190 @@
+import numpy as np
+
+# Tesseract's box output as a NumPy structured array, one record per glyph.
+# Coordinates are Tesseract's, with the origin at the bottom left of the image,
+# so y1 is the bottom of a glyph and y2 its top. flip_y converts to and from image coordinates.
+# Everything here works on whole arrays at once; nothing modifies the array it's given.
+
+BOX_DTYPE = np.dtype([
+	('char', 'U8'),
+	('x1', np.int32),
+	('y1', np.int32),
+	('x2', np.int32),
+	('y2', np.int32),
+	('page', np.int32),
+])
+BOX_COORDS = ['x1', 'y1', 'x2', 'y2', 'page']
+
+def empty_boxes():
+	return np.zeros(0, dtype = BOX_DTYPE)
+
+# parses Tesseract's box output ("char x1 y1 x2 y2 page" per line)
+def parse_boxes(text):
+	# the char is the only field that can contain a space, so split from the right
+	rows = [row for row in (line.rsplit(' ', 5) for line in text.split('\n') if line) if len(row) == 6]
+	boxes = np.zeros(len(rows), dtype = BOX_DTYPE)
+	if rows:
+		columns = list(zip(*rows))
+		boxes['char'] = columns[0]
+		coords = np.array(columns[1:], dtype = np.int32)
+		for index, name in enumerate(BOX_COORDS):
+			boxes[name] = coords[index]
+	return boxes
+
+# the inverse of parse_boxes
+def format_boxes(boxes):
+	rows = zip(boxes['char'].tolist(), *(boxes[name].tolist() for name in BOX_COORDS))
+	return "".join("{0} {1} {2} {3} {4} {5}\n".format(*row) for row in rows)
+
+# switches between Tesseract's (bottom left origin) and image (top left origin) coordinates,
+# keeping y1 <= y2 either way
+def flip_y(boxes, height):
+	flipped = boxes.copy()
+	flipped['y1'] = height - boxes['y2']
+	flipped['y2'] = height - boxes['y1']
+	return flipped
+
+def scale_boxes(boxes, x_scale, y_scale):
+	scaled = boxes.copy()
+	for name in ['x1', 'x2']:
+		scaled[name] = np.rint(boxes[name] * x_scale)
+	for name in ['y1', 'y2']:
+		scaled[name] = np.rint(boxes[name] * y_scale)
+	return scaled
+
+def offset_boxes(boxes, dx, dy):
+	offset = boxes.copy()
+	for name in ['x1', 'x2']:
+		offset[name] += dx
+	for name in ['y1', 'y2']:
+		offset[name] += dy
+	return offset
+
+# maps boxes through a 2x3 affine or 3x3 perspective matrix (as given to cv2.warpAffine/warpPerspective,
+# so in image coordinates) from an image src_height tall to one dst_height tall.
+# Each box becomes the box around its four transformed corners.
+def transform_boxes(boxes, matrix, src_height, dst_height):
+	image_boxes = flip_y(boxes, src_height)
+	xs = np.stack([image_boxes['x1'], image_boxes['x2'], image_boxes['x2'], image_boxes['x1']], axis = 1).astype(np.float64)
+	ys = np.stack([image_boxes['y1'], image_boxes['y1'], image_boxes['y2'], image_boxes['y2']], axis = 1).astype(np.float64)
+	matrix = np.asarray(matrix, dtype = np.float64)
+	new_xs = matrix[0, 0] * xs + matrix[0, 1] * ys + matrix[0, 2]
+	new_ys = matrix[1, 0] * xs + matrix[1, 1] * ys + matrix[1, 2]
+	if matrix.shape[0] == 3:
+		w = matrix[2, 0] * xs + matrix[2, 1] * ys + matrix[2, 2]
+		new_xs /= w
+		new_ys /= w
+
+	image_boxes['x1'] = np.floor(new_xs.min(axis = 1))
+	image_boxes['x2'] = np.ceil(new_xs.max(axis = 1))
+	image_boxes['y1'] = np.floor(new_ys.min(axis = 1))
+	image_boxes['y2'] = np.ceil(new_ys.max(axis = 1))
+	return flip_y(image_boxes, dst_height)
+
+def get_box_sizes(boxes):
+	return boxes['x2'] - boxes['x1'], boxes['y2'] - boxes['y1']
+
+# keeps the boxes that are at least min_width x min_height (and on the given page, if there is one)
+def filter_boxes(boxes, min_width = 0, min_height = 0, page = None):
+	widths, heights = get_box_sizes(boxes)
+	keep = (widths >= min_width) & (heights >= min_height)
+	if page is not None:
+		keep &= boxes['page'] == page
+	return boxes[keep]
+
+# Tesseract's TSV output, with word and line grouping and confidences.
+# Every TSV row has a level: 1 = page, 2 = block, 3 = paragraph, 4 = line, 5 = word.
+# Boxes are left/top/width/height in image coordinates, and conf is -1 on everything but words.
+
+PAGE_LEVEL = 1
+LINE_LEVEL = 4
+WORD_LEVEL = 5
+
+TSV_COLUMNS = ['level', 'page', 'block', 'par', 'line', 'word', 'left', 'top', 'width', 'height', 'conf', 'text']
+# a line is identified by these
+LINE_KEYS = ['page', 'block', 'par', 'line']
+
+# the text column is made as wide as the longest text in each parse
+def get_tsv_dtype(text_length):
+	return np.dtype([(name, np.int32) for name in TSV_COLUMNS[:10]] +
+		[('conf', np.float32), ('text', 'U{0}'.format(max(1, text_length)))])
+
+LINE_DTYPE = np.dtype([(name, np.int32) for name in LINE_KEYS + ['left', 'top', 'width', 'height']] +
+	[('conf', np.float32), ('word_count', np.int32)])
+
+# parses Tesseract's TSV output (header row included) into a structured array, one record per row
+def parse_tsv(text):
+	rows = [row for row in (line.split('\t', 11) for line in text.split('\n')[1:] if line) if len(row) == 12]
+	if not rows:
+		return np.zeros(0, dtype = get_tsv_dtype(1))
+	columns = list(zip(*rows))
+	tsv_rows = np.zeros(len(rows), dtype = get_tsv_dtype(max(len(t) for t in columns[11])))
+	numbers = np.array(columns[:10], dtype = np.int32)
+	for index, name in enumerate(TSV_COLUMNS[:10]):
+		tsv_rows[name] = numbers[index]
+	# Tesseract 4 writes whole number confidences, 5 writes decimals
+	tsv_rows['conf'] = np.array(columns[10], dtype = np.float32)
+	tsv_rows['text'] = columns[11]
+	return tsv_rows
+
+# groups the words (with a confidence) by line, and returns a LINE_DTYPE array in reading order.
+# A line's box covers its words, and its conf is the mean of theirs.
+def get_lines(tsv_rows):
+	words = tsv_rows[(tsv_rows['level'] == WORD_LEVEL) & (tsv_rows['conf'] >= 0)]
+	if len(words) == 0:
+		return np.zeros(0, dtype = LINE_DTYPE)
+	
+	keys = np.stack([words[name] for name in LINE_KEYS], axis = 1)
+	unique_keys, inverse = np.unique(keys, axis = 0, return_inverse = True)
+	inverse = inverse.reshape(-1)
+	line_count = len(unique_keys)
+	
+	lines = np.zeros(line_count, dtype = LINE_DTYPE)
+	for index, name in enumerate(LINE_KEYS):
+		lines[name] = unique_keys[:, index]
+		
+	lines['word_count'] = np.bincount(inverse, minlength = line_count)
+	lines['conf'] = np.bincount(inverse, weights = words['conf'], minlength = line_count) / lines['word_count']
+	
+	left = np.full(line_count, np.iinfo(np.int32).max, dtype = np.int32)
+	top = left.copy()
+	right = np.zeros(line_count, dtype = np.int32)
+	bottom = right.copy()
+	np.minimum.at(left, inverse, words['left'])
+	np.minimum.at(top, inverse, words['top'])
+	np.maximum.at(right, inverse, words['left'] + words['width'])
+	np.maximum.at(bottom, inverse, words['top'] + words['height'])
+	lines['left'] = left
+	lines['top'] = top
+	lines['width'] = right - left
+	lines['height'] = bottom - top
+	return lines
+
+
+# Word and line level OCR data for one image.
+#	rows: every TSV row (see parse_tsv)
+#	words: just the word rows
+#	lines: a LINE_DTYPE array, with each line's mean word confidence
+class OcrTextData:
+	def __init__(self, tsv_rows):
+		self.rows = tsv_rows
+		self.words = tsv_rows[tsv_rows['level'] == WORD_LEVEL]
+		self.lines = get_lines(tsv_rows)
+		
+	# the text of each line, joined with spaces, in the same order as self.lines
+	def get_line_texts(self):
+		line_texts = {}
+		for key, text in zip(zip(*(self.words[name].tolist() for name in LINE_KEYS)), self.words['text'].tolist()):
+			if text.strip():
+				line_texts.setdefault(key, []).append(text)
+		keys = zip(*(self.lines[name].tolist() for name in LINE_KEYS))
+		return [" ".join(line_texts.get(key, [])) for key in keys]
+		
+	# mean word confidence over the whole image, or -1 if no words were found
+	def get_mean_confidence(self):
+		confs = self.words['conf'][self.words['conf'] >= 0]
+		if len(confs) == 0:
+			return -1.0
+		return float(confs.mean())
+
+#EOF
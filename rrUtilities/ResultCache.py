@@ -0,0 +1,186 @@
+import numpy as np
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+
+# default memory budget for cached step images (a 12MP grayscale frame is ~12MB)
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# default disk budget for the persistent cache
+DEFAULT_MAX_DISK_BYTES = 2 * 1024 * 1024 * 1024
+# when the disk cache goes over budget, we evict down to this fraction of it, so we don't rescan on every write
+DISK_EVICTION_TARGET = 0.9
+# how many input images we remember the fingerprint of (see MemoryCache.fingerprint)
+FINGERPRINT_MEMO_SIZE = 4
+
+
+# hashes the pixel content of an image (plus its shape and dtype) into a hex string
+def fingerprint_image(img):
+	hasher = hashlib.sha1()
+	hasher.update("{0}|{1}|".format(img.shape, img.dtype).encode('utf8'))
+	hasher.update(np.ascontiguousarray(img).data)
+	return hasher.hexdigest()
+
+# combines the key of the previous step with the fingerprint of the next operation,
+# so the key of step k identifies the input image and every operation up to k
+def chain_key(prev_key, op_fingerprint):
+	return hashlib.sha1("{0}|{1}".format(prev_key, op_fingerprint).encode('utf8')).hexdigest()
+
+
+# A byte-bounded LRU of images, keyed by the strings produced by chain_key.
+# Cached images are made read-only so a consumer can't accidentally modify a shared entry.
+class MemoryCache:
+
+	def __init__(self, max_bytes = DEFAULT_MAX_BYTES):
+		self.max_bytes = max_bytes
+		self.total_bytes = 0
+		self.entries = OrderedDict()
+		self.fingerprints = OrderedDict()
+		self.lock = threading.Lock()
+
+	# Hashing a 12MP frame isn't free, so we remember the fingerprints of the last few
+	# input images by identity. We hold a reference to each one so its id can't be reused.
+	# NOTE: this assumes input images aren't modified in place after being processed
+	def fingerprint(self, img):
+		with self.lock:
+			entry = self.fingerprints.get(id(img))
+			if entry is not None and entry[0] is img:
+				self.fingerprints.move_to_end(id(img))
+				return entry[1]
+
+		fingerprint = fingerprint_image(img)
+
+		with self.lock:
+			self.fingerprints[id(img)] = (img, fingerprint)
+			while len(self.fingerprints) > FINGERPRINT_MEMO_SIZE:
+				self.fingerprints.popitem(last = False)
+		return fingerprint
+
+	def get(self, key):
+		with self.lock:
+			img = self.entries.get(key)
+			if img is not None:
+				self.entries.move_to_end(key)
+			return img
+
+	def put(self, key, img):
+		if img.nbytes > self.max_bytes:
+			return
+
+		img.flags.writeable = False
+
+		with self.lock:
+			if key in self.entries:
+				self.total_bytes -= self.entries.pop(key).nbytes
+			self.entries[key] = img
+			self.total_bytes += img.nbytes
+
+			while self.total_bytes > self.max_bytes:
+				old_key, old_img = self.entries.popitem(last = False)
+				self.total_bytes -= old_img.nbytes
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.fingerprints.clear()
+			self.total_bytes = 0
+
+
+# A content-addressed store of images on disk, shared between runs (and processes).
+# Entries are .npy files named after a hash of the salt and the key, so changing the salt
+# (e.g. when an operation's behavior changes) orphans all the old entries, which then age out.
+# Writes go to a temp file that is renamed into place, so readers never see a partial entry.
+class DiskCache:
+
+	def __init__(self, path, max_bytes = DEFAULT_MAX_DISK_BYTES, salt = ""):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.salt = salt
+		self.lock = threading.Lock()
+		
+		os.makedirs(self.path, exist_ok = True)
+		self.total_bytes = sum(entry[2] for entry in self.scan_entries())
+
+	def get_entry_path(self, key):
+		name = hashlib.sha1("{0}|{1}".format(self.salt, key).encode('utf8')).hexdigest()
+		# fan out into subdirectories so no single directory gets huge
+		return os.path.join(self.path, name[:2], name + ".npy")
+
+	def contains(self, key):
+		return os.path.exists(self.get_entry_path(key))
+
+	def get(self, key):
+		entry_path = self.get_entry_path(key)
+		try:
+			img = np.load(entry_path, allow_pickle = False)
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError) as error:
+			print("WARNING: removing unreadable disk cache entry {0} ({1})".format(entry_path, error))
+			self.remove_entry(entry_path)
+			return None
+
+		# bump the modification time, which is what eviction goes by
+		try:
+			os.utime(entry_path)
+		except OSError:
+			pass
+		return img
+
+	def put(self, key, img):
+		entry_path = self.get_entry_path(key)
+		temp_path = "{0}.{1}.{2}.tmp".format(entry_path, os.getpid(), threading.get_ident())
+		try:
+			os.makedirs(os.path.dirname(entry_path), exist_ok = True)
+			with open(temp_path, 'wb') as outfile:
+				np.save(outfile, img, allow_pickle = False)
+			os.replace(temp_path, entry_path)
+		except OSError as error:
+			print("WARNING: failed to write disk cache entry {0} ({1})".format(entry_path, error))
+			self.remove_entry(temp_path)
+			return
+
+		with self.lock:
+			self.total_bytes += os.path.getsize(entry_path)
+			should_evict = self.total_bytes > self.max_bytes
+		if should_evict:
+			self.evict()
+
+	def remove_entry(self, entry_path):
+		try:
+			os.remove(entry_path)
+		except OSError:
+			pass
+
+	# returns a list of [path, mtime, size] for every entry (other processes may be writing too)
+	def scan_entries(self):
+		entries = []
+		for root, dirs, files in os.walk(self.path):
+			for file in files:
+				if not file.endswith(".npy"):
+					continue
+				entry_path = os.path.join(root, file)
+				try:
+					stat = os.stat(entry_path)
+				except OSError:
+					continue
+				entries.append([entry_path, stat.st_mtime, stat.st_size])
+		return entries
+
+	# removes the least recently used entries until we're back under budget
+	def evict(self):
+		with self.lock:
+			entries = self.scan_entries()
+			entries.sort(key = lambda entry: entry[1])
+
+			total_bytes = sum(entry[2] for entry in entries)
+			target_bytes = self.max_bytes * DISK_EVICTION_TARGET
+			for entry_path, mtime, size in entries:
+				if total_bytes <= target_bytes:
+					break
+				self.remove_entry(entry_path)
+				total_bytes -= size
+			self.total_bytes = total_bytes
+
+#EOF
@@ -0,0 +1,61 @@
+# The StackOptimizer rewrites the ops of an OperationStack into an equivalent but cheaper
+# execution plan. The stack itself (what the editor shows) is never modified.
+#
+# It relies on two hooks on ImageOperation:
+# 	- is_identity(): the op currently doesn't change the image (e.g. NullOperation), so it's dropped
+# 	- fuse_with(next_op): returns the ops that replace the pair (self, next_op),
+#		[] if they cancel out, or None if they can't be fused
+
+
+# one entry in an execution plan: runs op, and produces the output of stack steps first..last
+class PlanStep:
+	def __init__(self, op, first, last):
+		self.op = op
+		self.first = first
+		self.last = last
+
+
+# Fusing two ops hides the output of the first one, so when the caller needs every step's
+# output (keep_intermediates, e.g. the editor) only dead ops are removed.
+def build_execution_plan(ops, keep_intermediates = True):
+	plan = []
+	# stack index of the first op that the next PlanStep covers
+	first = 0
+
+	for index, op in enumerate(ops):
+		if op.muted or op.is_identity():
+			continue
+
+		fused = None
+		if plan and not keep_intermediates:
+			fused = plan[-1].op.fuse_with(op)
+
+		if fused is None:
+			plan.append(PlanStep(op, first, index))
+		else:
+			prev = plan.pop()
+			if not fused:
+				# the pair cancelled out, so the next PlanStep also covers it
+				first = prev.first
+				continue
+			for fused_op in fused:
+				plan.append(PlanStep(fused_op, prev.first, index))
+		first = index + 1
+
+	return plan
+
+# The stack ops whose output step produces: the ops in step.first..step.last that actually run
+# unfused (the ones build_execution_plan doesn't drop), in order. Chaining their fingerprints gives a fused
+# step the same cache key the editor gives the last op it replaces, so the two share cache entries.
+def get_source_ops(ops, step):
+	return [op for op in ops[step.first:step.last + 1] if not op.muted and not op.is_identity()]
+
+# returns a human readable description of a plan, for debugging
+def describe_plan(plan, ops):
+	lines = ["Execution plan: {0} op(s) for {1} step(s)".format(len(plan), len(ops))]
+	for step in plan:
+		covered = ", ".join(op.get_label() for op in ops[step.first:step.last + 1])
+		lines.append("\t{0} <- [{1}]".format(step.op.get_fingerprint(), covered))
+	return "\n".join(lines)
+
+#EOF
@@ -0,0 +1,43 @@
+import copy
+
+# the latest-wins request loop
+from rrUtilities.LatestRequestThread import LatestRequestThread
+# ImageProcesser
+from rrUtilities.ImageOperations import *
+
+
+# Runs OperationStacks on a background thread for the StackEditor, so the UI stays responsive
+# while the ops run (cv2 releases the GIL while it works).
+# Only the latest request matters (see LatestRequestThread), and a run that has started is cancelled
+# between ops once it's superseded.
+# The stack is deep copied when the request is made, so the editor can keep changing its ops meanwhile.
+# This thread is the only user of the step caches it's given.
+class StackThreadManager (LatestRequestThread):
+
+	def __init__(self, cache = None, disk_cache = None):
+		LatestRequestThread.__init__(self, "STACK THREAD")
+		self.cache = cache
+		self.disk_cache = disk_cache
+		
+		self.start()
+		
+	# request is [stack, image, persist, scale]; returns [results, ops, scale]
+	def process_request(self, request_id, request):
+		stack, image, persist, scale = request
+		processer = ImageProcesser(stack, self.cache, self.disk_cache if persist else None)
+		processer.cancel_check = lambda: self.is_superseded(request_id)
+		if processer.process_color_image(image) is None:
+			return None
+		return [processer.get_last_results(), stack.get_stack(), scale]
+			
+	# Queues a run of stack on image (a color image), and returns the id of the new request.
+	# persist says whether the results go to the disk cache, and scale is how much the image
+	# was downscaled by (for proxy runs, see OperationStack.get_proxy_stack).
+	def start_processing(self, stack, image, persist = True, scale = 1.0):
+		snapshot = copy.deepcopy(stack)
+		
+		# the image itself is shared rather than a view, so the cache's memoized fingerprint of it is reused;
+		# the editor never modifies its images in place
+		return self.start_request([snapshot, image, persist, scale])
+
+#EOF
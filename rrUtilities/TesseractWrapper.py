@@ -14,73 +14,316 @@ import pytesseract
 # ---------------------
 import math
 import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-# we use Qt's threading so we can emit signals from the thread
-from PyQt5.QtCore import QThread
-from PyQt5.QtCore import pyqtSignal as Signal
+# BOX_DTYPE records and the helpers that work on them
+from rrUtilities.OcrData import *
+# caches for OCR results
+from rrUtilities.ResultCache import MemoryCache, DiskCache, chain_key, fingerprint_image
 
+# the latest-wins request loop, on a QThread so we can emit signals from the thread
+from rrUtilities.LatestRequestThread import LatestRequestThread
+
+
+
+# how many OpenMP threads each of several concurrent Tesseract processes should get,
+# so that workers * threads matches the number of cores
+def get_threads_per_worker(workers, cores = None):
+	if cores is None:
+		cores = os.cpu_count() or 1
+	return max(1, cores // max(1, workers))
+
+
+# How frames get to Tesseract:
+# 	- "png": we encode a PNG temp file with cv2 (slowest, since PNG compression costs a lot on 12MP frames)
+# 	- "pnm": we write an uncompressed PGM (or 1-bit PBM for black and white frames) to a temp file,
+#		on tmpfs (/dev/shm) where there is one
+# 	- "stdin": the same PNM bytes are piped straight into Tesseract, nothing is written at all
+TESSERACT_INPUT_MODES = ["png", "pnm", "stdin"]
+
+# the same configs pytesseract.image_to_boxes and image_to_data use, so every mode gives the same output as them
+# (TesseractWrapper.read_image_pytesseract is kept as the reference)
+BOX_CONFIG = ["-c", "tessedit_create_boxfile=1", "batch.nochop", "makebox"]
+TSV_CONFIG = ["-c", "tessedit_create_tsv=1"]
+
+# keeps OCR results apart from anything else in the same disk cache directory
+OCR_CACHE_SALT = "ocr"
+
+# where "pnm" mode writes its temp files
+def get_fast_temp_dir():
+	if os.path.isdir("/dev/shm"):
+		return "/dev/shm"
+	return tempfile.gettempdir()
+
+# encodes an 8-bit image as uncompressed PNM, which is just a header followed by the pixels:
+# PBM (1 bit per pixel) for black and white images, PGM for other grayscale, PPM for 3 channels
+def encode_pnm(img):
+	height, width = img.shape[:2]
+	if img.ndim == 3:
+		return b"P6\n%d %d\n255\n" % (width, height) + np.ascontiguousarray(img).tobytes()
+	if cv2.countNonZero(cv2.inRange(img, 1, 254)) == 0:
+		# a set bit is black, and each row is padded to whole bytes
+		return b"P4\n%d %d\n" % (width, height) + np.packbits(img == 0, axis = 1).tobytes()
+	return b"P5\n%d %d\n255\n" % (width, height) + np.ascontiguousarray(img).tobytes()
+
+# keeps a console window from flashing up for each Tesseract process on Windows
+def get_startupinfo():
+	if not hasattr(subprocess, 'STARTUPINFO'):
+		return None
+	startupinfo = subprocess.STARTUPINFO()
+	startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+	startupinfo.wShowWindow = subprocess.SW_HIDE
+	return startupinfo
+
+
+# Caches OCR results by the content of the image that was read, so reading the same frame again
+# (after muting an op that didn't change anything, reopening an image, or rerunning a batch)
+# doesn't start Tesseract at all. The results (BOX_DTYPE or TSV row arrays) are kept in a MemoryCache,
+# backed by a DiskCache that lasts between sessions if there is one. Cached results are read-only.
+class OcrCache:
+
+	def __init__(self, memory_cache = None, disk_cache = None):
+		self.memory_cache = memory_cache
+		self.disk_cache = disk_cache
+		
+	def get(self, key):
+		if self.memory_cache is not None:
+			result = self.memory_cache.get(key)
+			if result is not None:
+				return result
+		if self.disk_cache is not None:
+			result = self.disk_cache.get(key)
+			if result is not None:
+				if self.memory_cache is not None:
+					self.memory_cache.put(key, result)
+				return result
+		return None
+		
+	def put(self, key, result):
+		if self.memory_cache is not None:
+			self.memory_cache.put(key, result)
+		if self.disk_cache is not None:
+			self.disk_cache.put(key, result)
+
+# builds an OcrCache from config values (an empty disk_path means memory only)
+def create_ocr_cache(memory_mb, disk_path, disk_mb):
+	disk_cache = None
+	if disk_path:
+		disk_cache = DiskCache(disk_path, disk_mb * 1024 * 1024, OCR_CACHE_SALT)
+	return OcrCache(MemoryCache(memory_mb * 1024 * 1024), disk_cache)
 
 
 # This class returns the actual data obtained from Tesseract
 class TesseractWrapper:
 
-	def __init__(self, tesseract_path):
+	def __init__(self, tesseract_path, omp_threads = 4, input_mode = "png", cache = None):
 		pytesseract.pytesseract.tesseract_cmd = tesseract_path
-		print("Using pytesseract version: " + str(pytesseract.get_tesseract_version()))
+		self.tesseract_version = str(pytesseract.get_tesseract_version())
+		print("Using pytesseract version: " + self.tesseract_version)
+		self.cache = cache
 		
-		os.environ["OMP_THREAD_LIMIT"] = "4"
+		# the environment our tesseract processes run with; every wrapper has its own thread limit,
+		# so a TesseractPool and a TesseractWrapper in one process don't overwrite each other's
+		self.env = dict(os.environ)
+		self.env["OMP_THREAD_LIMIT"] = str(omp_threads)
 		
-	def read_image(self, img):
+		if input_mode not in TESSERACT_INPUT_MODES:
+			print("WARNING: unknown Tesseract input mode '{0}', using png".format(input_mode))
+			input_mode = "png"
+		self.input_mode = input_mode
+		
+	# runs Tesseract on a file (or "stdin", with input_data) and returns its output
+	def run_tesseract(self, input_name, input_data = None, config = BOX_CONFIG):
+		cmd = [pytesseract.pytesseract.tesseract_cmd, input_name, "stdout"] + config
+		proc = subprocess.run(cmd, input = input_data,
+			stdout = subprocess.PIPE, stderr = subprocess.PIPE, startupinfo = get_startupinfo(), env = self.env)
+		if proc.returncode:
+			raise pytesseract.TesseractError(proc.returncode, proc.stderr.decode('utf-8', 'replace').strip())
+		return proc.stdout.decode('utf-8')
+		
+	# writes img to a temp file (".pnm" or ".png") and runs Tesseract on it
+	def run_tesseract_on_temp_file(self, img, config, suffix):
+		if suffix == ".png":
+			data = cv2.imencode(".png", img)[1].tobytes()
+		else:
+			data = encode_pnm(img)
+		fd, filename = tempfile.mkstemp(suffix = suffix, dir = get_fast_temp_dir())
+		try:
+			with os.fdopen(fd, 'wb') as outfile:
+				outfile.write(data)
+			return self.run_tesseract(filename, None, config)
+		finally:
+			os.remove(filename)
+			
+	# runs Tesseract on an image with the current input mode.
+	# We don't go through pytesseract for "png", since it can't give Tesseract our environment.
+	def run_tesseract_on_image(self, img, config):
+		if self.input_mode == "png":
+			return self.run_tesseract_on_temp_file(img, config, ".png")
+		if self.input_mode == "pnm":
+			return self.run_tesseract_on_temp_file(img, config, ".pnm")
+		return self.run_tesseract("stdin", encode_pnm(img), config)
+		
+	# OCR cache key: the image content, plus everything about Tesseract that can change the output.
+	# The input mode isn't part of it, since every mode gives the same output.
+	def get_cache_key(self, img, config):
+		return chain_key(fingerprint_image(img), "{0}|{1}|{2}".format(
+			pytesseract.pytesseract.tesseract_cmd, self.tesseract_version, " ".join(config)))
+		
+	def read_image_uncached(self, img):
 
 		# read processed image using tesseract
-		bare_tesseract_data = pytesseract.image_to_boxes(img)
-		bare_tesseract_data = bare_tesseract_data.split('\n')
+		bare_tesseract_data = self.run_tesseract_on_image(img, BOX_CONFIG)
+			
+		return parse_boxes(bare_tesseract_data)
+		
+	# Reads img through pytesseract.image_to_boxes, the way every read worked before the input modes,
+	# as the reference for checking them against (see BatchRunner's -b). Never cached.
+	# pytesseract runs Tesseract with our process's environment, so this read ignores omp_threads.
+	def read_image_pytesseract(self, img):
+		return parse_boxes(pytesseract.image_to_boxes(img))
 		
-		boxes = []
-		for d in bare_tesseract_data:
-			boxes.append(d.split(' '))
+	# returns a BOX_DTYPE array
+	def read_image(self, img):
+		if self.cache is None:
+			return self.read_image_uncached(img)
 			
+		key = self.get_cache_key(img, BOX_CONFIG)
+		boxes = self.cache.get(key)
+		if boxes is None:
+			boxes = self.read_image_uncached(img)
+			self.cache.put(key, boxes)
 		return boxes
 		
+	# reads words and lines with their confidences, from Tesseract's TSV output; returns an OcrTextData
+	def read_words(self, img):
+		key = None
+		tsv_rows = None
+		if self.cache is not None:
+			key = self.get_cache_key(img, TSV_CONFIG)
+			tsv_rows = self.cache.get(key)
+			
+		if tsv_rows is None:
+			bare_tesseract_data = self.run_tesseract_on_image(img, TSV_CONFIG)
+			tsv_rows = parse_tsv(bare_tesseract_data)
+			if key is not None:
+				self.cache.put(key, tsv_rows)
+			
+		return OcrTextData(tsv_rows)
+		
+	# Reads several images with one Tesseract process, so the model is only loaded once.
+	# The images are listed in a text file, and Tesseract numbers its pages in the same order,
+	# which is how the last (page) column of the box output gets split back apart.
+	# The temp files are always PNM, whatever the input mode, since a list can't go through stdin.
+	# Returns one BOX_DTYPE array per image, like read_image.
+	# If the batch fails for any reason, the images are read one at a time instead.
+	# With a cache, only the images that miss go to Tesseract.
+	def read_images(self, imgs):
+		if self.cache is None:
+			return self.read_images_uncached(imgs)
+			
+		keys = [self.get_cache_key(img, BOX_CONFIG) for img in imgs]
+		pages = [self.cache.get(key) for key in keys]
+		misses = [index for index, boxes in enumerate(pages) if boxes is None]
+		
+		for index, boxes in zip(misses, self.read_images_uncached([imgs[index] for index in misses])):
+			self.cache.put(keys[index], boxes)
+			pages[index] = boxes
+		return pages
 		
-# handles async calls to Tesseract on a separate thread to prevent stalls
-class TesseractThreadManager (QThread):
+	def read_images_uncached(self, imgs):
+		if len(imgs) < 2:
+			return [self.read_image_uncached(img) for img in imgs]
+		
+		try:
+			with tempfile.TemporaryDirectory(dir = get_fast_temp_dir()) as temp_dir:
+				filenames = []
+				for index, img in enumerate(imgs):
+					filename = os.path.join(temp_dir, "{0}.pnm".format(index))
+					with open(filename, 'wb') as outfile:
+						outfile.write(encode_pnm(img))
+					filenames.append(filename)
+				
+				list_filename = os.path.join(temp_dir, "images.txt")
+				with open(list_filename, 'w', encoding = 'utf8') as outfile:
+					outfile.write("\n".join(filenames) + "\n")
+				
+				bare_tesseract_data = self.run_tesseract(list_filename)
+			
+			boxes = parse_boxes(bare_tesseract_data)
+			if len(boxes) and (boxes['page'].min() < 0 or boxes['page'].max() >= len(imgs)):
+				raise ValueError("page numbers don't match the {0} images".format(len(imgs)))
+					
+		except Exception as error:
+			print("WARNING: batch of {0} images failed in Tesseract ({1}), reading them one at a time".format(len(imgs), error))
+			return [self.read_image_uncached(img) for img in imgs]
+		
+		pages = []
+		for page in range(len(imgs)):
+			page_boxes = boxes[boxes['page'] == page]
+			# each image was page 0 on its own
+			page_boxes['page'] = 0
+			pages.append(page_boxes)
+		return pages
+		
+		
+# Runs several Tesseract processes at once. On many-core machines, a few single-threaded
+# Tesseract processes get through images faster than one multi-threaded process.
+# Each worker thread just waits on its Tesseract process, so threads are enough here.
+class TesseractPool:
 
-	onOperationComplete = Signal()
+	def __init__(self, tesseract_path, workers = None, cores = None, input_mode = "png", cache = None):
+		if cores is None:
+			cores = os.cpu_count() or 1
+		self.workers = workers if workers else cores
+		self.omp_threads = get_threads_per_worker(self.workers, cores)
+		
+		self.reader = TesseractWrapper(tesseract_path, self.omp_threads, input_mode, cache)
+		self.executor = ThreadPoolExecutor(max_workers = self.workers)
+		print("TesseractPool: {0} worker(s) with {1} thread(s) each".format(self.workers, self.omp_threads))
+		
+	# returns a Future of the BOX_DTYPE array (see TesseractWrapper.read_image)
+	def submit(self, img):
+		return self.executor.submit(self.reader.read_image, img)
+		
+	# returns a list of Futures, in the same order as imgs
+	def map(self, imgs):
+		return [self.submit(img) for img in imgs]
+		
+	def shutdown(self, wait = True):
+		self.executor.shutdown(wait)
+		
+		
+# Runs Tesseract on a background thread for the TesseractPreviewerWidget.
+# Only the latest read matters (see LatestRequestThread).
+class TesseractThreadManager (LatestRequestThread):
 	
-	def __init__(self, tesseract_path):
-		QThread.__init__(self)
+	def __init__(self, tesseract_path, input_mode = "png", cache = None):
+		LatestRequestThread.__init__(self, "TESSERACT THREAD")
 		self.tesseract_path = tesseract_path
-		self.cached_results = None
-		self.read_image_flag = False
+		self.input_mode = input_mode
+		self.cache = cache
+		# made on the thread, by the first read
+		self.tess_wrapper = None
 		
 		self.start()
-
-	def __del__(self):
-		self.wait()
-		
-	def run (self):
-		tess_wrapper = TesseractWrapper(self.tesseract_path)
-		
-		while True:
-			if self.read_image_flag:
-				print("TESSERACT THREAD: Read started")
-				image = np.copy(self.cached_image)
-				self.cached_results = tess_wrapper.read_image(image)
-				self.read_image_flag = False
-				print("TESSERACT THREAD: Read complete")
-				self.onOperationComplete.emit()
-			self.sleep(0)
+		
+	# request is the image to read; returns [image, boxes]
+	def process_request(self, request_id, image):
+		if self.tess_wrapper is None:
+			self.tess_wrapper = TesseractWrapper(self.tesseract_path, input_mode = self.input_mode, cache = self.cache)
 			
-
+		print("TESSERACT THREAD: Read {0} started".format(request_id))
+		return [image, self.tess_wrapper.read_image(image)]
+			
+	# returns the id of the new request
 	def start_read_image(self, image):
-		self.cached_image = image
-		# communicate to thread
-		self.read_image_flag = True
-		
-		
-	def get_cached_results(self):
-		return self.cached_results
+		# hand the thread a read-only view of the frame instead of a copy
+		view = image.view()
+		view.flags.writeable = False
+		return self.start_request(view)
 
 
 	"""
@@ -111,8 +354,9 @@ class TesseractDataVisualizer:
 		cv2_im = cv2.cvtColor(img,cv2.COLOR_GRAY2RGB)
 		h, w, channels = cv2_im.shape
 		
-		for b in boxes:
-			cv2.rectangle(cv2_im, (int(b[1]), h-int(b[2])), (int(b[3]), h-int(b[4])),(0,0,255),2)
+		flipped = flip_y(boxes, h)
+		for x1, y1, x2, y2 in zip(*(flipped[name].tolist() for name in ['x1', 'y1', 'x2', 'y2'])):
+			cv2.rectangle(cv2_im, (x1, y1), (x2, y2),(0,0,255),2)
 		
 		return cv2_im
 		
@@ -127,18 +371,14 @@ class TesseractDataVisualizer:
 		for corner in corners:
 			drawer.text((corner[0], corner[1]), str(corner), fill=(0,255,0))
 
-		for b in boxes:
-			string = b[0]
+		for string, posX, y1 in zip(boxes['char'].tolist(), boxes['x1'].tolist(), boxes['y1'].tolist()):
 			
 			for i in range(len(string)):
 				if ord(string[i]) > 255:
 					#print("Encountered bad char [" + string[i] + "], ord = " + str(ord(string[i])))
 					string = string[:i] + '?' + string[i+1:]
-					#drawer.rectangle((int(b[1]),int(b[2]),int(b[3]),int(b[4])), fill=(0,0,0))
-					#drawer.text((int(b[1]),int(b[2])), '?', fill=(255,0,0))
 		
-			posX = math.floor(int(b[1]))
-			posY = height - math.floor(int(b[2]))
+			posY = height - y1
 			drawer.text((posX, posY), string, fill=(0,0,0))
 		
 		return np.array(pil_image)
@@ -0,0 +1,92 @@
+# OpenCV ----
+import cv2
+import numpy as np
+# --------------
+
+# BOX_DTYPE helpers
+from rrUtilities.OcrData import *
+from rrUtilities.InkDetection import binarize_ink
+
+# Receipts are tall, narrow, and mostly whitespace, so instead of sending the whole frame to one
+# Tesseract process, we split the binarized image into horizontal bands of text at its blank rows,
+# found with a projection profile (how much ink each row has). The bands are cropped to their text,
+# OCR'd in parallel on a TesseractPool, and their boxes are moved back into the full image's coordinates.
+
+# runs of blank rows shorter than this don't split bands (the gaps in "=", "i", accents...)
+MIN_BAND_GAP = 8
+# blank pixels kept around each band, since Tesseract does worse on text touching the edge
+BAND_PADDING = 10
+
+# 255 where img has ink, which is the smaller of the two Otsu classes (see binarize_ink)
+def get_ink_mask(img):
+	if img.ndim == 3:
+		img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+	return binarize_ink(img)[0]
+
+# returns [top, bottom] (bottom exclusive) for each run of rows with ink,
+# where runs separated by fewer than min_gap blank rows count as one
+def find_text_bands(ink, min_gap = MIN_BAND_GAP):
+	has_ink = np.count_nonzero(ink, axis = 1) > 0
+	edges = np.diff(has_ink.astype(np.int8), prepend = 0, append = 0)
+	starts = np.flatnonzero(edges == 1)
+	ends = np.flatnonzero(edges == -1)
+	if len(starts) == 0:
+		return []
+
+	splits = np.flatnonzero(starts[1:] - ends[:-1] >= min_gap)
+	band_starts = starts[np.concatenate([[0], splits + 1])]
+	band_ends = ends[np.concatenate([splits, [len(ends) - 1]])]
+	return [[int(top), int(bottom)] for top, bottom in zip(band_starts, band_ends)]
+
+# merges neighbouring bands into at most count groups with roughly the same number of text rows,
+# so we start one Tesseract process per worker rather than one per line of text
+def group_bands(bands, count):
+	if len(bands) <= count:
+		return bands
+
+	target_rows = sum(bottom - top for top, bottom in bands) / count
+	groups = []
+	group_rows = 0
+	for top, bottom in bands:
+		if groups and (group_rows < target_rows or len(groups) == count):
+			groups[-1][1] = bottom
+		else:
+			groups.append([top, bottom])
+			group_rows = 0
+		group_rows += bottom - top
+	return groups
+
+# returns [top, bottom, left, right] around the text of each band, padded.
+# The padding only ever covers blank rows, so it stops at the neighbouring bands.
+def get_band_crops(ink, bands, padding = BAND_PADDING):
+	height, width = ink.shape
+	crops = []
+	for index, [top, bottom] in enumerate(bands):
+		prev_bottom = bands[index - 1][1] if index > 0 else 0
+		next_top = bands[index + 1][0] if index + 1 < len(bands) else height
+		columns = np.flatnonzero(np.any(ink[top:bottom], axis = 0))
+		crops.append([
+			max(top - padding, prev_bottom),
+			min(bottom + padding, next_top),
+			max(0, int(columns[0]) - padding),
+			min(width, int(columns[-1]) + 1 + padding)])
+	return crops
+
+# OCRs img band by band on a TesseractPool, and returns a single BOX_DTYPE array in img's coordinates
+def read_image_in_bands(pool, img, min_gap = MIN_BAND_GAP, padding = BAND_PADDING):
+	ink = get_ink_mask(img)
+	bands = group_bands(find_text_bands(ink, min_gap), pool.workers)
+	if not bands:
+		return empty_boxes()
+
+	crops = get_band_crops(ink, bands, padding)
+	futures = pool.map([img[top:bottom, left:right] for top, bottom, left, right in crops])
+
+	height = img.shape[0]
+	all_boxes = []
+	for [top, bottom, left, right], future in zip(crops, futures):
+		# Tesseract's y goes up from the bottom of the crop, which is (height - bottom) up from the bottom of img
+		all_boxes.append(offset_boxes(future.result(), left, height - bottom))
+	return np.concatenate(all_boxes)
+
+#EOF
@@ -1,21 +1,26 @@
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 import cv2
+import numpy as np
 import os
 
+# Wraps the image's memory in a QImage (with its row stride, so no padding is assumed)
+# and lets QPixmap.fromImage make the only copy. Grayscale and binary frames, which is
+# most of what the stack makes, are shown as Format_Grayscale8 instead of being expanded to RGB.
 def cv2_to_pixmap(cv2_img):
-	color_img = cv2_img
+	if len(cv2_img.shape) == 3 and cv2_img.shape[2] == 1:
+		cv2_img = cv2_img[:, :, 0]
+	# QImage needs each row to be contiguous; this only copies if they aren't
+	img = np.ascontiguousarray(cv2_img)
+	height, width = img.shape[:2]
 	
-	if len(cv2_img.shape) < 3:
-		#if image comes in as grayscale, make it color
-		color_img = cv2.cvtColor(cv2_img, cv2.COLOR_GRAY2RGB)
+	if len(img.shape) < 3:
+		image = QImage(img.data, width, height, img.strides[0], QImage.Format_Grayscale8)
 	else:
-		if cv2_img.shape[2] != 3:
-			print("CV2_to_Pixmap ERROR, channels not 1 or 3... ={0}".format(cv2_img.shape[2]))
-
-	height, width, channels = color_img.shape
-	byteValue = channels * width
-	image = QImage(color_img, width, height, byteValue, QImage.Format_RGB888)
+		if img.shape[2] != 3:
+			print("CV2_to_Pixmap ERROR, channels not 1 or 3... ={0}".format(img.shape[2]))
+		image = QImage(img.data, width, height, img.strides[0], QImage.Format_RGB888)
+	# fromImage copies the pixels, so img only has to outlive this call
 	return QPixmap.fromImage( image )
 
 
@@ -35,3 +40,10 @@ def is_int(s):
     except ValueError:
         return False
 
+
+def is_float(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
@@ -25,7 +25,7 @@ class PhotoViewer(QtWidgets.QGraphicsView):
 		return not self._empty
 
 	def fitInView(self, scale=True):
-		rect = QtCore.QRectF(self._photo.pixmap().rect())
+		rect = self._photo.sceneBoundingRect()
 		if not rect.isNull():
 			self.setSceneRect(rect)
 			if self.hasPhoto():
@@ -44,17 +44,25 @@ class PhotoViewer(QtWidgets.QGraphicsView):
 				
 			self._zoom = 0
 
-	def setPixmap(self, pixmap=None):
+	# scale is how much bigger to show the pixmap than it is, so a downscaled preview
+	# takes the same space as the full size image it stands in for
+	def setPixmap(self, pixmap=None, scale=1.0):
 		self._zoom = 0
 		if pixmap and not pixmap.isNull():			
+			old_rect = self._photo.sceneBoundingRect()
 			if self._photo.pixmap() is None \
-				or (self._photo.pixmap().height() != pixmap.height() or self._photo.pixmap().width() != pixmap.width()):
+				or (round(old_rect.height()) != round(pixmap.height() * scale) or round(old_rect.width()) != round(pixmap.width() * scale)):
 				self.just_updated = True
 				#pass
 		
 			self._empty = False
 			self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
 			self._photo.setPixmap(pixmap)
+			self._photo.setScale(scale)
+			# a viewer that's already showing won't get a showEvent to fit the new size in
+			if self.just_updated and self.isVisible():
+				self.fitInView()
+				self.just_updated = False
 		else:
 			self._empty = True
 			self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
@@ -3,6 +3,9 @@ from PyQt5.QtCore import pyqtSignal as Signal
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from rrWidgets.PhotoViewer import PhotoViewer
 # OpStack
 from rrUtilities.ImageOperations import *
@@ -21,10 +24,57 @@ def clearLayout(layout):
 
 
 
+# thumbnails in the FullStackPreviewerWidget are this many pixels across
+THUMBNAIL_SIZE = 95
+# how many thumbnails the FullStackPreviewerWidget keeps, across steps and images
+THUMBNAIL_CACHE_SIZE = 64
+THUMBNAIL_WORKERS = 2
+
+# shrinks img (with INTER_AREA, which averages rather than skipping pixels) so its longest side is size
+def downscale_for_thumbnail(img, size):
+	height, width = img.shape[:2]
+	factor = size / max(height, width)
+	if factor >= 1.0:
+		return img
+	return cv2.resize(img, (max(1, round(width * factor)), max(1, round(height * factor))), interpolation = cv2.INTER_AREA)
+
+
+# how many full size pixmaps the StackPreviewerWidget keeps for recently viewed tabs
+PREVIEW_PIXMAP_CACHE_SIZE = 4
+
+# A small LRU of pixmaps, keyed by step key, so flipping between tabs (or the after image of one tab
+# being the before image of the next) doesn't convert the same frame twice.
+class PixmapCache:
+	def __init__(self, max_entries = PREVIEW_PIXMAP_CACHE_SIZE):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		
+	# returns the pixmap for key, calling make_pixmap to create it if it isn't cached
+	def get(self, key, make_pixmap):
+		# results from a processer without a cache have no keys to go by
+		if key is None:
+			return make_pixmap()
+		pix = self.entries.get(key)
+		if pix is not None:
+			self.entries.move_to_end(key)
+			return pix
+		pix = make_pixmap()
+		self.entries[key] = pix
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last = False)
+		return pix
+		
+	def clear(self):
+		self.entries.clear()
+
+
 # For a given operation, two images are shown: before and after the operation.
+# setup only keeps references to the frames; the pixmaps are made in render, when the tab is shown.
 class OperationViewerWidget(QWidget):
-	def __init__(self, parent = None):
+	def __init__(self, parent = None, pixmap_cache = None):
 		super(OperationViewerWidget, self).__init__(parent)
+		self.pixmap_cache = pixmap_cache if pixmap_cache is not None else PixmapCache()
+		self.rendered = False
 		self.setSizePolicy(self.getSizePolicy())
 		self.setMinimumSize(QSize(200, 600))
 
@@ -59,14 +109,16 @@ class OperationViewerWidget(QWidget):
 		sizePolicy.setVerticalStretch(0)
 		return sizePolicy
 
-	def setup(self, before, after, update=False):
+	# op is the operation between the two, if it has an overlay to draw on the before image.
+	# scale is passed on to PhotoViewer.setPixmap, for proxy previews.
+	def setup(self, before, after, update=False, op=None, scale=1.0):
 		self.before = before
 		self.after = after
+		self.op = op
+		self.scale = scale
 		self.before_label.setText(before[1])
 		self.after_label.setText(after[1])
-		
-		self.set_image_on_label(before[0], self.before_img)
-		self.set_image_on_label(after[0], self.after_img)
+		self.rendered = False
 
 		# HACK to not resize images when just updating, cuz I'm lazy
 		if update:
@@ -74,12 +126,34 @@ class OperationViewerWidget(QWidget):
 			#self.before_img.just_updated = False
 			#self.after_img.just_updated = False
 			
-	def set_image_on_label(self, cv2_img, label):
-		pix = cv2_to_pixmap(cv2_img)
-		label.setPixmap(pix)
+	# makes (or reuses) the pixmaps for the frames from the last setup, if it hasn't already
+	def render(self):
+		if self.rendered:
+			return
+		self.rendered = True
+		
+		before_key = self.before[2]
+		if self.has_overlay():
+			# the overlay depends on the op's settings as well as the frame
+			before_key = (before_key, self.op.get_fingerprint())
+		before_pix = self.pixmap_cache.get(before_key, self.make_before_pixmap)
+		after_pix = self.pixmap_cache.get(self.after[2], lambda: cv2_to_pixmap(self.after[0]))
+		self.before_img.setPixmap(before_pix, self.scale)
+		self.after_img.setPixmap(after_pix, self.scale)
+		
+	def has_overlay(self):
+		return self.op is not None and self.op.has_overlay()
+		
+	def make_before_pixmap(self):
+		before_img = self.before[0]
+		if self.has_overlay():
+			overlay = self.op.draw_overlay(before_img)
+			if overlay is not None:
+				before_img = overlay
+		return cv2_to_pixmap(before_img)
 			
 	def selected(self):
-		pass
+		self.render()
 
 # this widget has tabs across the top, one for each operation. 
 class StackPreviewerWidget(QDockWidget):
@@ -100,6 +174,10 @@ class StackPreviewerWidget(QDockWidget):
 		
 		self.rebuildingTabs = False
 		
+		self.tabs = []
+		# shared by the tabs; only the visible tab makes pixmaps
+		self.pixmap_cache = PixmapCache()
+		
 		#bind to signals on StackEditor application
 		if parent is not None:
 			parent.onOperationSelected.connect(self.set_current_index)
@@ -108,16 +186,25 @@ class StackPreviewerWidget(QDockWidget):
 	def clear(self):
 		self.rebuildingTabs = True
 		self.tabWidget.clear()
+		self.tabs = []
 		self.rebuildingTabs = False
 		
-	def update_from_results(self, results):
+	def render_current_tab(self):
+		index = self.tabWidget.currentIndex()
+		if index >= 0 and len(self.tabs) > index:
+			self.tabs[index].render()
+		
+	# ops are the operations that made the results, for their overlays.
+	# Proxy results (see StackEditor.refresh_proxy) are shown scale times bigger, to fill the same space.
+	def update_from_results(self, results, ops=None, scale=1.0):
 		prev_result = results[0]
 		for index, (tab, result) in enumerate(zip(self.tabs, results[1:])):
-			tab.setup(prev_result, result, True)
+			tab.setup(prev_result, result, True, ops[index] if ops else None, scale)
 			prev_result = result
 			self.tabWidget.setTabText(index, result[1])
+		self.render_current_tab()
 		
-	def setup_from_results(self, results):
+	def setup_from_results(self, results, ops=None, scale=1.0):
 		self.rebuildingTabs = True
 		
 		self.tabWidget.clear()
@@ -126,14 +213,15 @@ class StackPreviewerWidget(QDockWidget):
 		for ind in range(1, len(results)):
 			step = results[ind]
 
-			tab = OperationViewerWidget(self)
-			tab.setup(prev_step, step)
+			tab = OperationViewerWidget(self, self.pixmap_cache)
+			tab.setup(prev_step, step, False, ops[ind - 1] if ops else None, scale)
 			prev_step = step
 			
 			self.tabWidget.addTab(tab, step[1])
 			self.tabs.append(tab)
 			
 		self.rebuildingTabs = False
+		self.render_current_tab()
 		
 	def tab_changed(self, index):
 		if index >= 0 and len(self.tabs) > index and not self.rebuildingTabs:
@@ -298,12 +386,11 @@ class FullStackPreviewerImageWidget(QPushButton):
 	def sizeHint(self):
 		return QSize(100, 100)
 
-	def setup(self, result, update=False):
-		pix = cv2_to_pixmap(result[0])
+	def set_thumbnail(self, pix):
 		icon = QIcon()
 		icon.addPixmap(pix)
 		self.setIcon(icon)
-		self.setIconSize(QSize(95, 95))
+		self.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
 		
 	def set_selected(self, selected):
 		if selected:
@@ -315,10 +402,15 @@ class FullStackPreviewerImageWidget(QPushButton):
 	def on_clicked(self):
 		self.onSelected.emit(self.index)
 
-# this widget shows all the steps of a stack
+# this widget shows all the steps of a stack.
+# Thumbnails are downscaled on a small thread pool and cached by step key (so by content),
+# and a step's thumbnail is only redone when its key changes. The pixmaps are made on the GUI thread
+# as each thumbnail comes in through thumbnailReady.
 class FullStackPreviewerWidget(QDockWidget):
 
 	onOperationSelected = Signal(int)
+	# step key, downscaled image
+	thumbnailReady = Signal(str, object)
 
 	def __init__(self, parent = None):
 		super(FullStackPreviewerWidget, self).__init__("Stack Previewer", parent)
@@ -327,40 +419,97 @@ class FullStackPreviewerWidget(QDockWidget):
 		self.setMinimumSize(QSize(600, 100))
 		
 		self.steps = []
+		# the key of the step each widget in self.steps shows (or is waiting for)
+		self.step_keys = []
 		self.layout = QHBoxLayout()
 		self.container = QWidget()
 		self.container.setLayout(self.layout)
 		self.setWidget(self.container)
 		
+		# step key -> thumbnail pixmap, least recently used first
+		self.thumbnails = OrderedDict()
+		# keys with a thumbnail being made
+		self.pending_keys = set()
+		self.uncached_count = 0
+		self.executor = ThreadPoolExecutor(max_workers = THUMBNAIL_WORKERS)
+		# set by shutdown; thumbnails that arrive after it are dropped
+		self.closed = False
+		self.thumbnailReady.connect(self.thumbnail_ready)
+		
 		#bind to signals on StackEditor application
 		if parent is not None:
 			parent.onOperationSelected.connect(self.set_current_index)
 	
+	# drops the queued thumbnails and waits for the ones being made, so no worker outlives the widget
+	def shutdown(self):
+		self.closed = True
+		self.executor.shutdown(wait = True, cancel_futures = True)
+	
 	def operation_selected(self, index):
 		#print("op selected: {}".format(index))
 		self.onOperationSelected.emit(index)
 	
 	def clear(self):
 		clearLayout(self.layout)
+		self.steps = []
+		self.step_keys = []
 		
 	def update_from_results(self, results):
-		for img, result in zip(self.steps, results):
-			img.setup(result, True)
+		for index, result in enumerate(results[:len(self.steps)]):
+			self.show_thumbnail(index, result)
+			
+	# shows the cached thumbnail of the result on the step widget at index, or asks the pool for one
+	def show_thumbnail(self, index, result):
+		key = result[2]
+		if key is None:
+			# results from a processer without a cache have no keys, so each one gets a key of its own
+			self.uncached_count += 1
+			key = "uncached{0}".format(self.uncached_count)
+		if self.step_keys[index] == key:
+			return
+		self.step_keys[index] = key
+		
+		pix = self.thumbnails.get(key)
+		if pix is not None:
+			self.thumbnails.move_to_end(key)
+			self.steps[index].set_thumbnail(pix)
+		elif key not in self.pending_keys and not self.closed:
+			self.pending_keys.add(key)
+			self.executor.submit(self.make_thumbnail, key, result[0])
+			
+	# runs on the pool
+	def make_thumbnail(self, key, img):
+		self.thumbnailReady.emit(key, downscale_for_thumbnail(img, THUMBNAIL_SIZE))
+		
+	def thumbnail_ready(self, key, thumbnail):
+		if self.closed:
+			return
+		self.pending_keys.discard(key)
+		pix = cv2_to_pixmap(thumbnail)
+		self.thumbnails[key] = pix
+		while len(self.thumbnails) > THUMBNAIL_CACHE_SIZE:
+			self.thumbnails.popitem(last = False)
+			
+		for step, step_key in zip(self.steps, self.step_keys):
+			if step_key == key:
+				step.set_thumbnail(pix)
 		
 	def setup_from_results(self, results):
 		# remove all widgets
 		clearLayout(self.layout)
 		self.steps = []
+		self.step_keys = []
 		
 		for ind in range(0, len(results)):
 			step = results[ind]
 
 			img = FullStackPreviewerImageWidget(max(0, ind - 1), self)
 			img.onSelected.connect(self.operation_selected)
-			img.setup(step)
 			
 			self.layout.addWidget(img)
 			self.steps.append(img)
+			self.step_keys.append(None)
+			self.show_thumbnail(ind, step)
 		
 		self.layout.addStretch()
 		
@@ -63,11 +63,15 @@ class TesseractPreviewWidget(QDockWidget):
 		
 		# TODO add error label that appear if a tesseract operation fails
 		
-	def setup(self, tesseract_path):
+	def setup(self, tesseract_path, input_mode = "png", ocr_cache = None):
 		self.data_vis = TesseractDataVisualizer()
 		
-		self.thread_manager = TesseractThreadManager(tesseract_path)
-		self.thread_manager.onOperationComplete.connect(self.processing_finished)
+		self.thread_manager = TesseractThreadManager(tesseract_path, input_mode, ocr_cache)
+		self.thread_manager.onRequestComplete.connect(self.processing_finished)
+		self.thread_manager.onRequestFailed.connect(self.processing_failed)
+		
+	def shutdown(self):
+		self.thread_manager.stop()
 		
 	def update_from_results(self, results):
 	
@@ -101,14 +105,27 @@ class TesseractPreviewWidget(QDockWidget):
 		else:
 			print("Latest processed image is None!")
 			
-	def processing_finished(self):
+	def processing_failed(self, request_id, error):
+		if not self.thread_manager.is_latest(request_id):
+			return
+		self.spinner_label.setVisible(False)
+		# let the user try again
+		self.update_button.setEnabled(True)
+		
+	def processing_finished(self, request_id):
+		results = self.thread_manager.get_results(request_id)
+		if results is None:
+			# a newer read is on its way
+			return
+		
 		self.spinner_label.setVisible(False)
 	
-		boxes = self.thread_manager.get_cached_results()
+		# draw on the image that was actually read, which might not be latest_image anymore
+		image, boxes = results
 
 		if boxes is not None:
 			# Draw the bounding box
-			bounds_img = self.data_vis.draw_text_bounds(boxes, self.latest_image)
+			bounds_img = self.data_vis.draw_text_bounds(boxes, image)
 			
 			#resize
 			resizer = ImageResizer(bounds_img.shape)